@@ -0,0 +1,150 @@
+"""
+Times analyze_nests end to end and per stage on synthetic cities of different sizes, without Overpass or a DB.
+
+    python -m benchmarks.analyze --sizes 250,1000,4000 --mode bulk
+
+A city of size n has n parks (a tenth of them relations) and spawnpoints, pokestops and sightings per park
+as given. Stage times come from the run report of analyze_nests. "db read" is timed around the stand-in's
+queries and is also part of "mon counting" (bulk/less) or "classification" (per park queries).
+"""
+import argparse
+import logging
+import os
+import tempfile
+import time
+import timeit
+
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+
+import nestwatcher.analyze as analyze
+
+from nestwatcher.area import Area
+from nestwatcher.config import Config
+from nestwatcher.logging import log
+from nestwatcher.osmfile import from_json, write_osm
+from nestwatcher.stats import RunStats
+from benchmarks.localdb import LocalQueries
+from benchmarks.synthetic import city_osm, osm_bounds, scanner_data
+
+NEST_MONS = [1, 4, 7, 25, 35, 37, 43, 54, 58, 60, 63, 66]
+SETTINGS = {
+    "min_pokemon": 9,
+    "min_spawnpoints": 2,
+    "min_average": 0.5,
+    "min_ratio": 0,
+    "scan_hours_per_day": 24,
+    "max_markers": 30,
+    "discord": ""
+}
+DB_READS = ["stops", "spawns", "mons", "all_mons", "bbox_stops", "bbox_spawns", "bbox_mons", "bbox_mon_counts", "park_mons"]
+
+class Stages():
+    def __init__(self):
+        self.times = defaultdict(float)
+        self._patched = []
+
+    def wrap(self, owner, name, stage):
+        func = getattr(owner, name)
+
+        @wraps(func)
+        def timed(*args, **kwargs):
+            start = timeit.default_timer()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.times[stage] += timeit.default_timer() - start
+
+        self._patched.append((owner, name, func))
+        setattr(owner, name, timed)
+
+    def restore(self):
+        for owner, name, func in reversed(self._patched):
+            setattr(owner, name, func)
+        self._patched = []
+
+@contextmanager
+def workdir():
+    # analyze_nests reads and writes relative to data/
+    old = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        for sub in ("osm_data", "area_data", "state_data"):
+            os.makedirs(os.path.join(directory, "data", sub))
+        os.chdir(directory)
+        try:
+            yield directory
+        finally:
+            os.chdir(old)
+
+def city(size, args):
+    relations = size // 10
+    osm = city_osm(size - relations, relations, seed=args.seed)
+    now = time.time()
+    data = scanner_data(
+        osm, size * args.spawns, size * args.stops, size * args.sightings, NEST_MONS,
+        start=now - 48 * 3600, end=now, seed=args.seed
+    )
+    min_lat, min_lon, max_lat, max_lon = osm_bounds(osm)
+    area = Area({"name": "Benchmark", "path": [
+        [min_lat - 0.01, min_lon - 0.01], [min_lat - 0.01, max_lon + 0.01],
+        [max_lat + 0.01, max_lon + 0.01], [max_lat + 0.01, min_lon - 0.01]
+    ]}, dict(SETTINGS))
+    return osm, data, area, now - 48 * 3600
+
+def run(config, osm, data, area, reset_time, cached=False):
+    """Returns ({stage: seconds}, nests found). With cached, parks are built once before the timed run"""
+    queries = LocalQueries(config, data)
+    with workdir():
+        write_osm(analyze.osm_path(area), from_json(osm))
+        if cached:
+            analyze.load_parks(config, area, {}, config.park_workers, RunStats())
+
+        stages = Stages()
+        for name in DB_READS:
+            stages.wrap(queries, name, "db read")
+        try:
+            start = timeit.default_timer()
+            nests, _, report = analyze.analyze_nests(config, area, NEST_MONS, queries, reset_time, False)
+            total = timeit.default_timer() - start
+        finally:
+            stages.restore()
+
+    times = defaultdict(float, report["stages"])
+    times.update(stages.times)
+    times["total"] = total
+    return times, len(nests)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="250,1000,4000", help="Comma separated number of parks per city")
+    parser.add_argument("--mode", default="bulk", choices=["query", "less", "bulk", "set", "aggregate"])
+    parser.add_argument("--spawns", type=int, default=20, help="Spawnpoints per park")
+    parser.add_argument("--stops", type=int, default=5, help="Pokestops per park")
+    parser.add_argument("--sightings", type=int, default=500, help="Sightings per park")
+    parser.add_argument("--cached", action="store_true", help="Time runs with an existing park cache")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--config", default="config_example/config.ini")
+    args = parser.parse_args()
+
+    config = Config(args.config)
+    config.workers = 1
+    config.less_queries = args.mode == "less"
+    config.bulk_queries = args.mode in ("bulk", "set", "aggregate")
+    config.set_queries = args.mode == "set"
+    config.pre_aggregate = args.mode == "aggregate"
+    config.incremental = False
+    log.setLevel(logging.WARNING)
+
+    stage_names = [
+        "osm load", "prefilter", "polygons", "connect", "geofence", "centers", "park cache",
+        "mon counting", "classification", "details", "insert", "db read", "total"
+    ]
+    print(f"{'parks':>7} {'nests':>6} " + " ".join(f"{name:>14}" for name in stage_names))
+    for size in [int(s) for s in args.sizes.split(",")]:
+        osm, data, area, reset_time = city(size, args)
+        times, nest_count = run(config, osm, data, area, reset_time, args.cached)
+        print(f"{size:>7} {nest_count:>6} " + " ".join(f"{times[name]:>13.3f}s" for name in stage_names))
+
+if __name__ == "__main__":
+    main()
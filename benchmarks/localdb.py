@@ -0,0 +1,157 @@
+"""
+In-memory stand-in for nestwatcher.queries.Queries. It answers the same calls from synthetic scanner data
+(see benchmarks.synthetic.scanner_data) so analyze_nests can run without a scanner or nest DB.
+Results follow the SQL in Queries. Ties between equally often seen mons go to the lower pokemon_id.
+"""
+import numpy as np
+import shapely
+
+from shapely import geometry
+from shapely.ops import unary_union
+
+from nestwatcher.queries import Queries
+
+def fence_polygon(fence):
+    # "(lat lon,...)" or "(lat lon,...),(lat lon,...)" as used in sql_fence
+    polygons = []
+    for ring in fence.strip("()").split("),("):
+        points = [point.split() for point in ring.split(",")]
+        polygons.append(geometry.Polygon([(float(lon), float(lat)) for lat, lon in points]))
+    return unary_union(polygons)
+
+def top_mon(mon_ids):
+    if len(mon_ids) == 0:
+        return None
+    mons, counts = np.unique(mon_ids, return_counts=True)
+    best = counts.argmax()
+    return mons[best].item(), int(counts[best])
+
+class LocalQueries():
+    # Only the scheduling helpers are shared with the real class
+    map = Queries.map
+    gather = Queries.gather
+
+    def __init__(self, config, data):
+        self.config = config
+        self.pool_size = 1
+        self.data = data
+        self.spawn_ids = [int(i) for i in data["spawn_ids"]]
+        self.stop_ids = list(data["stop_ids"])
+        self.spawn_index = {str(spawn_id): i for i, spawn_id in enumerate(self.spawn_ids)}
+        self.stop_index = {stop_id: i for i, stop_id in enumerate(self.stop_ids)}
+        self.nests = []
+        self.set_run([], 0)
+
+    def set_run(self, nest_mons, reset_time):
+        self.nest_mons = np.array([int(m) for m in nest_mons], dtype=int)
+        self.reset_time = reset_time
+        self.run_mask = np.isin(self.data["mon_ids"], self.nest_mons) & (self.data["mon_time"] >= reset_time)
+        self.run_sightings = np.nonzero(self.run_mask)[0]
+
+        # Sightings of this run sorted by spawnpoint and pokestop, so the ones of a spawnpoint are one slice
+        self._by_spawn = self._positions(self.data["mon_spawn"], len(self.spawn_ids))
+        self._by_stop = self._positions(self.data["mon_stop"], len(self.stop_ids))
+
+    def _positions(self, column, count):
+        keys = column[self.run_sightings]
+        order = np.argsort(keys, kind="stable")
+        bounds = np.searchsorted(keys[order], np.arange(count + 1), side="left")
+        return self.run_sightings[order], bounds
+
+    def _sightings(self, by, indexes):
+        positions, bounds = by
+        if not indexes:
+            return np.empty(0, dtype=int)
+        return np.concatenate([positions[bounds[i]:bounds[i + 1]] for i in indexes])
+
+    def _batches(self, rows):
+        size = self.config.stream_batch_size
+        if size <= 0:
+            return [rows]
+        return iter([rows[i:i + size] for i in range(0, len(rows), size)])
+
+    def _rows(self, ids, lat, lon, mask):
+        return [(ids[i], lat[i].item(), lon[i].item()) for i in np.nonzero(mask)[0]]
+
+    def _in_fence(self, fence, lat, lon):
+        return shapely.contains_xy(fence_polygon(fence), lon, lat)
+
+    def _in_bounds(self, bounds, lat, lon):
+        min_lon, min_lat, max_lon, max_lat = bounds
+        return (lat >= min_lat) & (lat <= max_lat) & (lon >= min_lon) & (lon <= max_lon)
+
+    def _mon_row(self, i, settle_time=None):
+        spawn = self.data["mon_spawn"][i]
+        stop = self.data["mon_stop"][i]
+        return (
+            int(self.data["mon_ids"][i]),
+            self.spawn_ids[spawn] if spawn >= 0 else None,
+            self.stop_ids[stop] if stop >= 0 else None,
+            None if settle_time is None else int(self.data["mon_time"][i] < settle_time)
+        )
+
+    def _bbox_sightings(self, bounds, since):
+        data = self.data
+        since = self.reset_time if since is None else since
+        mask = self.run_mask & self._in_bounds(bounds, data["mon_lat"], data["mon_lon"])
+        mask &= data["mon_time"] >= since
+        return np.nonzero(mask)[0]
+
+    def stops(self, area):
+        data = self.data
+        return self._rows(self.stop_ids, data["stop_lat"], data["stop_lon"], self._in_fence(area, data["stop_lat"], data["stop_lon"]))
+
+    def spawns(self, area):
+        data = self.data
+        return self._rows(self.spawn_ids, data["spawn_lat"], data["spawn_lon"], self._in_fence(area, data["spawn_lat"], data["spawn_lon"]))
+
+    def mons(self, spawns, pokestops=None):
+        sightings = np.union1d(
+            self._sightings(self._by_spawn, [self.spawn_index[s] for s in spawns]),
+            self._sightings(self._by_stop, [self.stop_index[s] for s in pokestops or []])
+        )
+        return top_mon(self.data["mon_ids"][sightings])
+
+    def all_mons(self, fence):
+        data = self.data
+        mask = self.run_mask & self._in_fence(fence, data["mon_lat"], data["mon_lon"])
+        return self._batches(self._rows(data["mon_ids"].tolist(), data["mon_lat"], data["mon_lon"], mask))
+
+    def bbox_stops(self, bounds):
+        data = self.data
+        return self._rows(self.stop_ids, data["stop_lat"], data["stop_lon"], self._in_bounds(bounds, data["stop_lat"], data["stop_lon"]))
+
+    def bbox_spawns(self, bounds):
+        data = self.data
+        return self._rows(self.spawn_ids, data["spawn_lat"], data["spawn_lon"], self._in_bounds(bounds, data["spawn_lat"], data["spawn_lon"]))
+
+    def bbox_mons(self, bounds, since=None, settle_time=None):
+        return self._batches([self._mon_row(i, settle_time) for i in self._bbox_sightings(bounds, since)])
+
+    def bbox_mon_counts(self, bounds, since=None, settle_time=None):
+        counts = {}
+        for i in self._bbox_sightings(bounds, since):
+            row = self._mon_row(i, settle_time)
+            counts[row] = counts.get(row, 0) + 1
+        return self._batches([row + (count,) for row, count in counts.items()])
+
+    def park_mons(self, park_spawns, park_stops):
+        parks = {}
+        for by, index, rows in ((self._by_spawn, self.spawn_index, park_spawns), (self._by_stop, self.stop_index, park_stops)):
+            for park_id, member_id in rows:
+                parks.setdefault(park_id, []).append(self._sightings(by, [index[str(member_id)]]))
+        result = []
+        for park_id, sightings in parks.items():
+            mon = top_mon(self.data["mon_ids"][np.unique(np.concatenate(sightings))])
+            if mon is not None:
+                result.append((park_id, *mon))
+        return result
+
+    def most_mon(self):
+        return top_mon(self.data["mon_ids"][self.run_sightings])
+
+    def nest_write(self, area, nests, delete=True):
+        self.nests = list(nests)
+
+    def close(self):
+        pass
@@ -0,0 +1,60 @@
+"""
+Times relation polygon assembly on a relation-heavy synthetic OSM file.
+Compares the id indexed way table with a linear scan over all ways (how members used to be looked up).
+
+    python -m benchmarks.relations --ways 20000 --relations 2000
+"""
+import argparse
+import timeit
+
+from nestwatcher.area import WayPark, RelPark
+from nestwatcher.config import Config
+from nestwatcher.osmfile import from_json
+from benchmarks.synthetic import city_osm
+
+class LinearWays():
+    def __init__(self, ways):
+        self.ways = ways
+
+    def get(self, way_id):
+        way = [w for w in self.ways if w.id == way_id]
+        return way[0] if way else None
+
+def parse(osm, config):
+    nodes = from_json(osm)
+    ways = [WayPark(element, config) for element in nodes.ways]
+    relations = [RelPark(element, config) for element in nodes.relations]
+    return nodes, ways, relations
+
+def assemble(nodes, ways, relations, way_table):
+    double_ways = set()
+    for park in relations:
+        park.path = []
+        double_ways = park.get_polygon(nodes, way_table, double_ways)
+    return double_ways
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ways", type=int, default=5000, help="Plain park ways")
+    parser.add_argument("--relations", type=int, default=1000, help="Park relations, each with 5 member ways")
+    parser.add_argument("--config", default="config_example/config.ini")
+    args = parser.parse_args()
+
+    config = Config(args.config)
+    nodes, ways, relations = parse(city_osm(args.ways, args.relations), config)
+    print(f"{len(ways)} ways, {len(relations)} relations")
+
+    start = timeit.default_timer()
+    indexed = assemble(nodes, ways, relations, {way.id: way for way in ways})
+    indexed_time = timeit.default_timer() - start
+    print(f"id index:    {indexed_time:.2f}s")
+
+    start = timeit.default_timer()
+    linear = assemble(nodes, ways, relations, LinearWays(ways))
+    linear_time = timeit.default_timer() - start
+    print(f"linear scan: {linear_time:.2f}s ({linear_time / indexed_time:.1f}x slower)")
+
+    assert indexed == linear
+
+if __name__ == "__main__":
+    main()
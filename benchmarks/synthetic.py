@@ -0,0 +1,125 @@
+"""Generators for synthetic Overpass and scanner data, so the nest pipeline can be timed without a real city"""
+import math
+import random
+import numpy as np
+
+class OSMBuilder():
+    def __init__(self, seed=0):
+        self.random = random.Random(seed)
+        self.elements = []
+        self._next_node = 1
+        self._next_way = 100000000
+        self._next_relation = 900000000
+
+    def node(self, lat, lon):
+        node_id = self._next_node
+        self._next_node += 1
+        self.elements.append({"type": "node", "id": node_id, "lat": lat, "lon": lon})
+        return node_id
+
+    def ring(self, lat, lon, size, points=8):
+        # Closed ring of node ids around a center, slightly irregular so polygons aren't all the same
+        nodes = []
+        for i in range(points):
+            angle = 2 * math.pi * i / points
+            r = size * (0.8 + self.random.random() * 0.4)
+            nodes.append(self.node(lat + r * math.sin(angle), lon + r * math.cos(angle)))
+        return nodes + nodes[:1]
+
+    def way(self, nodes, tags=None):
+        way_id = self._next_way
+        self._next_way += 1
+        self.elements.append({"type": "way", "id": way_id, "nodes": nodes, "tags": tags or {}})
+        return way_id
+
+    def relation(self, outer, inner=(), tags=None):
+        relation_id = self._next_relation
+        self._next_relation += 1
+        members = [{"type": "way", "ref": w, "role": "outer"} for w in outer]
+        members += [{"type": "way", "ref": w, "role": "inner"} for w in inner]
+        self.elements.append({"type": "relation", "id": relation_id, "members": members, "tags": tags or {}})
+        return relation_id
+
+    def park_way(self, lat, lon, size):
+        tags = {"leisure": "park"}
+        if self.random.random() < 0.5:
+            tags["name"] = f"Park {self._next_way}"
+        return self.way(self.ring(lat, lon, size), tags)
+
+    def park_relation(self, lat, lon, size, segments=4):
+        # The outer ring is split into several open ways that have to be merged, plus one inner ring
+        outer_ring = self.ring(lat, lon, size, points=segments * 3)
+        step = (len(outer_ring) - 1) // segments
+        outer = [self.way(outer_ring[i * step:(i + 1) * step + 1]) for i in range(segments)]
+        inner = [self.way(self.ring(lat, lon, size / 4))]
+        return self.relation(outer, inner, {"leisure": "park", "name": f"Relation {self._next_relation}"})
+
+    def json(self):
+        return {"elements": self.elements}
+
+def grid(count, lat=50.0, lon=8.0, spacing=0.01):
+    """count cell centers on a square grid starting at lat, lon"""
+    side = math.ceil(math.sqrt(count))
+    for i in range(count):
+        yield lat + (i // side) * spacing, lon + (i % side) * spacing
+
+def city_osm(ways=1000, relations=100, seed=0, spacing=0.01):
+    builder = OSMBuilder(seed)
+    cells = list(grid(ways + relations, spacing=spacing))
+    builder.random.shuffle(cells)
+    for lat, lon in cells[:ways]:
+        builder.park_way(lat, lon, spacing * 0.3)
+    for lat, lon in cells[ways:]:
+        builder.park_relation(lat, lon, spacing * 0.4)
+    return builder.json()
+
+def osm_bounds(osm):
+    """(min_lat, min_lon, max_lat, max_lon) of all nodes"""
+    lats = [e["lat"] for e in osm["elements"] if e["type"] == "node"]
+    lons = [e["lon"] for e in osm["elements"] if e["type"] == "node"]
+    return min(lats), min(lons), max(lats), max(lons)
+
+def scanner_data(osm, spawnpoints, pokestops, sightings, nest_mons, start, end, seed=0, spacing=0.01):
+    """
+    Spawnpoints, pokestops and sightings spread over the area of a synthetic OSM file.
+    Every grid cell has its own nesting species that makes up most of the sightings there, so parks turn into nests.
+    Sightings reference spawnpoints and pokestops by their position in those arrays, -1 if there's none.
+    """
+    rng = np.random.default_rng(seed)
+    min_lat, min_lon, max_lat, max_lon = osm_bounds(osm)
+
+    def points(count):
+        return rng.uniform(min_lat, max_lat, count), rng.uniform(min_lon, max_lon, count)
+
+    spawn_lat, spawn_lon = points(spawnpoints)
+    stop_lat, stop_lon = points(pokestops)
+
+    # Most mons spawn on spawnpoints, the rest are lured or incense-like spawns on pokestops
+    on_stop = rng.random(sightings) < 0.1 if pokestops else np.zeros(sightings, dtype=bool)
+    spawn_idx = np.where(on_stop, -1, rng.integers(0, max(spawnpoints, 1), sightings))
+    stop_idx = np.where(on_stop, rng.integers(0, max(pokestops, 1), sightings), -1)
+    lat = np.where(on_stop, stop_lat[np.maximum(stop_idx, 0)] if pokestops else 0, spawn_lat[np.maximum(spawn_idx, 0)])
+    lon = np.where(on_stop, stop_lon[np.maximum(stop_idx, 0)] if pokestops else 0, spawn_lon[np.maximum(spawn_idx, 0)])
+
+    nest_mons = np.array(nest_mons, dtype=int)
+    cells = ((lat - min_lat) // spacing).astype(int) * 1000 + ((lon - min_lon) // spacing).astype(int)
+    mon_ids = np.where(
+        rng.random(sightings) < 0.6,
+        nest_mons[cells % len(nest_mons)],
+        rng.integers(1, 400, sightings)
+    )
+
+    return {
+        "spawn_ids": np.arange(1, spawnpoints + 1) * 1000003,
+        "spawn_lat": spawn_lat,
+        "spawn_lon": spawn_lon,
+        "stop_ids": np.array([f"{i:032x}.16" for i in range(pokestops)], dtype=object),
+        "stop_lat": stop_lat,
+        "stop_lon": stop_lon,
+        "mon_ids": mon_ids,
+        "mon_spawn": spawn_idx,
+        "mon_stop": stop_idx,
+        "mon_lat": lat,
+        "mon_lon": lon,
+        "mon_time": rng.uniform(start, end, sightings)
+    }
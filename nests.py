@@ -1,20 +1,26 @@
 import json
+import asyncio
 import argparse
 import requests
 import discord
 import time
 import sys
 import math
+import multiprocessing
 
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
+from itertools import repeat
 from geojson import FeatureCollection, dumps
 
 from nestwatcher.area import Area
-from nestwatcher.analyze import analyze_nests
+from nestwatcher.analyze import analyze_nests, analyze_area, fetch_osm_data, send_poracle
 from nestwatcher.config import Config
 from nestwatcher.logging import log
+from nestwatcher.profiling import profiled
 from nestwatcher.queries import Queries
-from nestwatcher.discord import get_emotes
+from nestwatcher.stats import write_prometheus, write_report
+from nestwatcher.discord import get_emotes, send_nest_messages, send_webhooks, webhook_embeds
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-c", "--config", default="config/config.ini", help="Config file to use")
@@ -22,63 +28,98 @@ parser.add_argument("-t", "--hours", default=None, help="Hours since last migrat
 parser.add_argument("-a", "--area", default=None, help="A specific area to analyze")
 parser.add_argument("-ne", "--noevents", action='store_true', help="Ignore event data")
 parser.add_argument("-nd", "--nodelete", action='store_true', help="Don't delete nests")
+parser.add_argument("-w", "--workers", default=None, type=int, help="Number of areas to analyze at the same time")
+parser.add_argument("-p", "--profile", action='store_true', help="Profile each area and save the stats to data/profiles")
+parser.add_argument("-d", "--daemon", action='store_true', help="Keep running and look for nests again every --interval minutes")
+parser.add_argument("-i", "--interval", default=15, type=int, help="Minutes between runs in daemon mode")
 args = parser.parse_args()
 config_path = args.config
 config = Config(config_path)
+if args.workers is not None:
+    config.workers = args.workers
+config.profile = args.profile
+config.daemon = args.daemon
+if config.set_queries and not config.bulk_queries:
+    log.warning("set_queries only works with bulk_queries. Turning it off")
+    config.set_queries = False
+if config.pre_aggregate and not config.bulk_queries:
+    log.warning("pre_aggregate only works with bulk_queries. Turning it off")
+    config.pre_aggregate = False
+if config.incremental and not config.bulk_queries:
+    log.warning("Incremental runs only work with bulk_queries. Turning them off")
+    config.incremental = False
+if config.incremental and config.set_queries:
+    log.warning("Incremental runs count sightings locally, so set_queries is ignored")
+    config.set_queries = False
+if config.incremental and config.scanner == "mad":
+    log.warning("Incremental runs need RDM's first_seen_timestamp. MAD's last_modified changes with every sighting, so they're turned off")
+    config.incremental = False
+
+EVENTS_URL = "https://raw.githubusercontent.com/ccev/pogoinfo/v2/active/events.json"
+# How often daemon mode looks for a new migration time between scheduled runs
+MIGRATION_CHECK = 300
 
 def timestr_to_datetime(time):
     return datetime.strptime(time, "%Y-%m-%d %H:%M")
 
-# Auto migration time
-events = requests.get("https://raw.githubusercontent.com/ccev/pogoinfo/v2/active/events.json").json()
-hours_since_migration = False
-if config.auto_time:
-    last_migration_timestamp = requests.get("https://raw.githubusercontent.com/ccev/pogoinfo/info/last-nest-migration").text
-    last_migration = datetime.fromtimestamp(int(last_migration_timestamp))
-    last_regular_migration = last_migration
-
-    local_time = datetime.now()
-    for event in events:
-        if not event["type"] == "event":
-            continue
-        if not (event["start"]) or (not event["end"]):
-            continue
-        event_start = timestr_to_datetime(event["start"])
-        if event_start > local_time:
-            continue
-        event_end = timestr_to_datetime(event["end"])
-        
-        if event_end <= last_migration:
-            continue
+def get_migration(events, quiet=False):
+    """Returns (last_migration, last_regular_migration) and updates config.hours_since_change"""
+    # Auto migration time
+    hours_since_migration = False
+    if config.auto_time:
+        last_migration_timestamp = requests.get("https://raw.githubusercontent.com/ccev/pogoinfo/info/last-nest-migration").text
+        last_migration = datetime.fromtimestamp(int(last_migration_timestamp))
+        last_regular_migration = last_migration
+
+        local_time = datetime.now()
+        for event in events:
+            if not event["type"] == "event":
+                continue
+            if not (event["start"]) or (not event["end"]):
+                continue
+            event_start = timestr_to_datetime(event["start"])
+            if event_start > local_time:
+                continue
+            event_end = timestr_to_datetime(event["end"])
+
+            if event_end <= last_migration:
+                continue
+
+            if (event_start <= last_migration) and (event_end > local_time):
+                continue
+
+            if event_end < local_time:
+                last_migration = event_end
+                if not quiet:
+                    log.info(f"Overwriting nest migration with the end time of {event['name']}")
+            else:
+                last_migration = event_start
+                if not quiet:
+                    log.info(f"Overwriting nest migration with the start time of {event['name']}")
+
+        if not quiet:
+            log.success(f"Last migration: {last_migration}")
+    else:
+        hours_since_migration = config.hours_since_change
+        last_regular_migration = None
+
+    if args.hours is not None:
+        hours_since_migration = int(args.hours)
+        if not quiet:
+            log.info(f"Overwriting hours since change with {config.hours_since_change}")
+    if hours_since_migration:
+        config.hours_since_change = hours_since_migration
+        last_migration = datetime.now() - timedelta(hours=hours_since_migration)
+    else:
+        # TODO: this is a hotfix so mon_avg doesnt break
+        td = datetime.now() - last_migration
+        days, seconds = td.days, td.seconds
+        config.hours_since_change = math.floor(days * 24 + seconds / 3600)
+        if config.hours_since_change <= 0:
+            config.hours_since_change = 1
+
+    return last_migration, last_regular_migration
 
-        if (event_start <= last_migration) and (event_end > local_time):
-            continue
-        
-        if event_end < local_time:
-            last_migration = event_end
-            log.info(f"Overwriting nest migration with the end time of {event['name']}")
-        else:
-            last_migration = event_start
-            log.info(f"Overwriting nest migration with the start time of {event['name']}")
-
-    log.success(f"Last migration: {last_migration}")
-else:
-    hours_since_migration = config.hours_since_change
-    last_regular_migration = None
-
-if args.hours is not None:
-    hours_since_migration = int(args.hours)
-    log.info(f"Overwriting hours since change with {config.hours_since_change}")
-if hours_since_migration:
-    config.hours_since_change = hours_since_migration
-    last_migration = datetime.now() - timedelta(hours=hours_since_migration)
-else:
-    # TODO: this is a hotfix so mon_avg doesnt break
-    td = datetime.now() - last_migration
-    days, seconds = td.days, td.seconds
-    config.hours_since_change = math.floor(days * 24 + seconds / 3600)
-    if config.hours_since_change <= 0:
-        config.hours_since_change = 1
 if args.noevents:
     config.use_events = False
 
@@ -94,8 +135,6 @@ if args.area is not None:
         log.error("Couldn't find that area. Maybe check capitalization")
         sys.exit()
 
-reset_time = datetime.timestamp(last_migration)
-
 defaults = {
     "min_pokemon": 9,
     "min_spawnpoints": 2,
@@ -122,166 +161,204 @@ for setting in settings:
     for k, v in defaults.items():
         area_settings[setting["area"]][k] = setting.get(k, v)
 
-# Event Data
-
-event_mons = set()
-if config.use_events:
-    events = requests.get("https://raw.githubusercontent.com/ccev/pogoinfo/v2/active/events.json").json()
-    for event in events:
-        if "season" in event["name"].lower():
-            continue
-        if not event["start"] or not event["end"]:
-            continue
-        if not event["type"] in ["event", "spotlight-hour", "community-day"]:
-            continue
-        start = timestr_to_datetime(event["start"])
-        end = timestr_to_datetime(event["end"])
-        if end < last_migration:
+def get_nest_mons(events, last_migration, queries, reset_time):
+    """Returns (all nesting species, the ones to look for in this run)"""
+    # Event Data
+
+    event_mons = set()
+    if config.use_events:
+        for event in events:
+            if "season" in event["name"].lower():
+                continue
+            if not event["start"] or not event["end"]:
+                continue
+            if not event["type"] in ["event", "spotlight-hour", "community-day"]:
+                continue
+            start = timestr_to_datetime(event["start"])
+            end = timestr_to_datetime(event["end"])
+            if end < last_migration:
+                continue
+            if start > datetime.now():
+                continue
+            log.info(f"Found active event since last migration: {event['name']}")
+            mons = {str(m["id"]) for m in event["spawns"]}
+            event_mons = event_mons.union(mons)
+        if len(event_mons) == 0:
+            log.info("Found no Event spawns since last migration")
+
+    # Getting nesting species
+
+    #nesting_mons = requests.get("https://pogoapi.net/api/v1/nesting_pokemon.json").json().keys()
+    nesting_mons = requests.get("https://raw.githubusercontent.com/ccev/pogoinfo/v2/nests/species-ids.json").json()
+    nesting_mons = nesting_mons.get(config.hemisphere, nesting_mons["all"])
+    nesting_mons = [str(m) for m in nesting_mons]
+    nest_mons = [m for m in nesting_mons if m not in event_mons]
+    log.info("Got all nesting species")
+    log.debug(nest_mons)
+
+    # Meganests
+    if config.in_meganest:
+        log.info("You're living in a meganest. Getting the mosg scanned mon from your DB and ignoring it for the rest of the run")
+        queries.set_run(nest_mons, reset_time)
+        most_mon = str(queries.most_mon()[0])
+        if most_mon in nest_mons:
+            nest_mons.remove(most_mon)
+
+    return nesting_mons, nest_mons
+
+def analyze(full_areas, nest_mons, queries, reset_time, pool=None):
+    # New areas are all queued for Overpass at once instead of one by one while analyzing
+    fetch_osm_data(config, full_areas)
+    if pool is not None:
+        log.info(f"Analyzing {len(full_areas)} areas with {config.workers} workers")
+        results = list(pool.map(analyze_area, repeat(config), full_areas, repeat(nest_mons), repeat(reset_time), repeat(args.nodelete)))
+    else:
+        results = [
+            profiled(config.profile, area_.name, analyze_nests, config, area_, nest_mons, queries, reset_time, args.nodelete)
+            for area_ in full_areas
+        ]
+
+    all_features = []
+    reports = []
+    for area_, (nests, poracle_data, report) in zip(full_areas, results):
+        reports.append(report)
+        area_.nests = nests
+        for nest in nests:
+            all_features.append(nest.feature)
+        if config.poracle:
+            send_poracle(config, poracle_data)
+
+    if config.run_report:
+        write_report(config.run_report, reports)
+    if config.prometheus_file:
+        write_prometheus(config.prometheus_file, reports)
+
+    with open(config.json_path, "w+") as file_:
+        file_.write(dumps(FeatureCollection(all_features), indent=4))
+        log.info("Saved Geojson file")
+
+def notify(full_areas, nesting_mons, last_regular_migration):
+    # Discord stuff
+    discord_webhook_data = []
+    discord_message_data = []
+
+    for area in full_areas:
+        if len(area.nests) == 0:
+            log.warning(f"Did not find any nests in {area.name} - Skipping notifications")
             continue
-        if start > datetime.now():
-            continue
-        log.info(f"Found active event since last migration: {event['name']}")
-        mons = {str(m["id"]) for m in event["spawns"]}
-        event_mons = event_mons.union(mons)
-    if len(event_mons) == 0:
-        log.info("Found no Event spawns since last migration")
-
-# Getting nesting species
-
-#nesting_mons = requests.get("https://pogoapi.net/api/v1/nesting_pokemon.json").json().keys()
-nesting_mons = requests.get("https://raw.githubusercontent.com/ccev/pogoinfo/v2/nests/species-ids.json").json()
-nesting_mons = nesting_mons.get(config.hemisphere, nesting_mons["all"])
-nesting_mons = [str(m) for m in nesting_mons]
-nest_mons = [m for m in nesting_mons if m not in event_mons]
-log.info("Got all nesting species")
-log.debug(nest_mons)
-
-# DB
-log.info("Establishing DB connection")
-queries = Queries(config)
-
-# Meganests
-if config.in_meganest:
-    log.info("You're living in a meganest. Getting the mosg scanned mon from your DB and ignoring it for the rest of the run")
-    most_mon = str(queries.most_mon(str(tuple(nest_mons)), str(reset_time))[0])
-    if most_mon in nest_mons:
-        nest_mons.remove(most_mon)
-
-all_features = []
-full_areas = []
-for i, area in enumerate(areas):
-    area_ = Area(area, area_settings[area["name"]])
-    nests = analyze_nests(config, area_, nest_mons, queries, reset_time, args.nodelete)
-    area_.nests = nests
-    full_areas.append(area_)
-
-    for nest in nests:
-        all_features.append(nest.feature)
-
-with open(config.json_path, "w+") as file_:
-    file_.write(dumps(FeatureCollection(all_features), indent=4))
-    log.info("Saved Geojson file")
-queries.close()
-
-# Discord stuff
-discord_webhook_data = []
-discord_message_data = []
-
-for area in full_areas:
-    if len(area.nests) == 0:
-        log.warning(f"Did not find any nests in {area.name} - Skipping notifications")
-        continue
-    d = area.settings["discord"]
-    if isinstance(d, str):
-        if "webhooks" in d:
-            discord_webhook_data.append([d, area])
-    elif isinstance(d, int):
-        discord_message_data.append([d, area])
-
-
-if len(discord_message_data) > 0:
-    log.info("Logging into Discord")
-    bot = discord.Client()
-
-    @bot.event
-    async def on_ready():
-        try:
-            log.info("Connected to Discord. Generating Nest messages and sending them.")
+        d = area.settings["discord"]
+        if isinstance(d, str):
+            if "webhooks" in d:
+                discord_webhook_data.append([d, area])
+        elif isinstance(d, int):
+            discord_message_data.append([d, area])
+
+    if not discord_message_data and not discord_webhook_data:
+        return
+
+    async def send_notifications(bot=None):
+        # Emotes are only synced once, then every message and webhook is sent with them
+        emote_refs = None
+        if bot is not None:
             emote_refs = await get_emotes(bot, nesting_mons, config)
-            for d, area in discord_message_data:
-                try:
-                    channel = await bot.fetch_channel(d)
-                    found = False
-                    embed_dict, _ = area.get_nest_text(config, emote_refs, last_regular_migration, config.time_format)
-                    embed = discord.Embed().from_dict(embed_dict)
-                    async for message in channel.history():
-                        if message.author == bot.user:
-                            embeds = message.embeds
-                            if len(embeds) > 0:
-                                if embeds[0].title == embed.title:
-                                    found = True
-                                    break
-                    if found:
-                        log.success(f"Found existing Nest message for {area.name} and editing it")
-                        await message.edit(embed=embed)
-                    else:
-                        log.success(f"Sending a new Nest message for {area.name}")
-                        await channel.send(embed=embed)
-                except Exception as e:
-                    log.exception(e)
+        webhooks = []
+        for webhook_link, area in discord_webhook_data:
+            embed_dict, entry_list = area.get_nest_text(config, emote_refs, last_regular_migration, config.time_format)
+            webhooks.append((webhook_link, area.name, webhook_embeds(embed_dict, entry_list)))
+        if webhooks:
+            log.info("Sending webhooks")
+
+        tasks = [send_webhooks(webhooks, config.webhook_concurrency)]
+        if bot is not None and discord_message_data:
+            log.info("Connected to Discord. Generating Nest messages and sending them.")
+            tasks.append(send_nest_messages(bot, discord_message_data, emote_refs, config, last_regular_migration))
+        await asyncio.gather(*tasks)
+
+    # A Discord client closes its event loop when it's done, so a daemon needs a new one for every run
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    if discord_message_data or config.discord_token:
+        log.info("Logging into Discord")
+        bot = discord.Client()
+
+        @bot.event
+        async def on_ready():
+            try:
+                await send_notifications(bot)
+            except Exception as e:
+                log.exception(e)
+            await bot.close()
+
+        bot.run(config.discord_token)
+    else:
+        asyncio.run(send_notifications())
+
+def run(full_areas, queries, pool=None):
+    """One full nest run. Returns the migration time it used"""
+    # The events are needed for the migration time and for event spawns, so they're only fetched once
+    events = requests.get(EVENTS_URL).json()
+    last_migration, last_regular_migration = get_migration(events)
+    reset_time = datetime.timestamp(last_migration)
+
+    nesting_mons, nest_mons = get_nest_mons(events, last_migration, queries, reset_time)
+    analyze(full_areas, nest_mons, queries, reset_time, pool)
+    notify(full_areas, nesting_mons, last_regular_migration)
+
+    log.success("All done.")
+    return last_migration
+
+def migration_changed(last_migration):
+    # Migrations that are only hours back from now move with every check
+    if not config.auto_time or args.hours is not None:
+        return False
+    migration, _ = get_migration(requests.get(EVENTS_URL).json(), quiet=True)
+    return migration != last_migration
+
+def daemon(full_areas, queries, pool=None):
+    """
+    Re-runs every interval minutes and as soon as the migration time changes. Parks, their spatial indexes and
+    DB connections stay in memory, so after the first run only DB queries and counting are left.
+    """
+    interval = args.interval * 60
+    last_migration = None
+    next_run = 0
+    while True:
+        now = time.time()
+        try:
+            if now >= next_run or migration_changed(last_migration):
+                if now < next_run:
+                    log.info("Migration time changed. Looking for nests now")
+                next_run = now + interval
+                queries.ping()
+                last_migration = run(full_areas, queries, pool)
+                log.info(f"Next run at {datetime.fromtimestamp(next_run).strftime('%H:%M')}")
         except Exception as e:
+            # A failed run (e.g. the DB or GitHub being unreachable) is tried again on the next check
             log.exception(e)
-        await bot.close()
-
-    bot.run(config.discord_token)
+        time.sleep(max(1, min(MIGRATION_CHECK, next_run - time.time())))
 
-if len(discord_webhook_data) > 0:
-    log.info("Sending webhooks")
-
-    for webhook_link, area in discord_webhook_data:
-        entry_list_2 = []
-        entries = []
+# DB
+log.info("Establishing DB connection")
+queries = Queries(config)
 
-        emote_refs = None
-        if config.discord_token:
-            bot = discord.Client()
-            @bot.event
-            async def on_ready():
-                bot.emote_refs = await get_emotes(bot, nesting_mons, config)
-                await bot.close()
-            bot.run(config.discord_token)
-            emote_refs = bot.emote_refs
-
-        embed_dict, entry_list = area.get_nest_text(config, emote_refs, last_regular_migration, config.time_format)
-
-        text = ""
-        while len(entry_list) > 0:
-            text = ""
-            for entry in entry_list:
-                if len(entry+text) > 2048:
-                    entries.append(text)
-                    break
-                text += entry
-                entry_list_2.append(entry)
-            entry_list = [e for e in entry_list if e not in entry_list_2]
-        if text and text not in entries:
-            entries.append(text)
-
-        for i, entry in enumerate(entries):
-            embed = {
-                "description": entry
-            }
-            keys = ["color"]
-            if i == 0:
-                keys += ["title", "url", "thumbnail", "author"]
-            if i == len(entries) - 1:
-                keys += ["timestamp", "footer", "image"]
-            for key in keys:
-                if key in embed_dict.keys():
-                    embed[key] = embed_dict[key]
-        
-            r = requests.post(webhook_link, json={"embeds": [embed]})
-            log.success(f"Sent Webhook for {area.name} ({r.status_code})")
-            time.sleep(1)
-
-log.success("All done.")
\ No newline at end of file
+full_areas = [Area(area, area_settings[area["name"]]) for area in areas]
+config.workers = min(config.workers, len(full_areas))
+if config.workers > 1 and "fork" not in multiprocessing.get_all_start_methods():
+    log.warning("Analyzing areas in parallel needs fork() support. Analyzing them one after another")
+    config.workers = 1
+
+pool = None
+if config.workers > 1:
+    # This script runs on import, so workers have to be forked instead of spawned
+    pool = ProcessPoolExecutor(max_workers=config.workers, mp_context=multiprocessing.get_context("fork"))
+
+try:
+    if config.daemon:
+        daemon(full_areas, queries, pool)
+    else:
+        run(full_areas, queries, pool)
+except KeyboardInterrupt:
+    log.info("Stopping")
+finally:
+    if pool is not None:
+        pool.shutdown()
+    queries.close()
@@ -1,34 +1,198 @@
-import sys
+import os
 import json
 import time
 import timeit
 import requests
+import numpy as np
 
 from rich.progress import Progress
-from shapely import geometry
-from shapely.ops import polylabel, cascaded_union
 from shapely.errors import TopologicalError
-from geojson import Feature
 from collections import defaultdict
 
 from nestwatcher.logging import log
+from nestwatcher.osmfile import find_osm_file
 from nestwatcher.overpass import get_osm_data
 from nestwatcher.area import WayPark, RelPark
+from nestwatcher.connect import connect_parks
+from nestwatcher.parallel import ParkPool, in_geofence, park_centers
+from nestwatcher.parkcache import park_cache_key, park_cache_name, read_park_cache, write_park_cache
+from nestwatcher.profiling import profiled
+from nestwatcher.queries import Queries
+from nestwatcher.spatial import ParkIndex, boxes_outside, columns, count_mons, fence_polygon, member_rows, merge_counts, merge_groups, sighting_groups, top_mons
+from nestwatcher.state import SETTLE_TIME, load_state, save_state
+from nestwatcher.stats import RunStats
+from nestwatcher.tiles import area_tiles, merge_osm, tile_bbox, tile_dir, tile_path
+
+# Daemon mode keeps each area's parks and spatial indexes here between runs
+park_memory = {}
+# Area workers of a daemon keep their DB connections between runs
+worker_queries = None
 
 def osm_date():
     return "2019-02-24T00:00:00Z"
 
-def analyze_nests(config, area, nest_mons, queries, reset_time, nodelete):
-    OSM_DATE = osm_date()
+def osm_path(area):
+    return f"data/osm_data/{area.name} {osm_date().replace(':', '')}.osm"
+
+def osm_jobs(config, area):
+    """(name, bbox, file name) of the OSM files an area's data is made of"""
+    # OSM files per area from before tiles existed are still used
+    if config.osm_tile_size <= 0 or find_osm_file(osm_path(area)):
+        return [(area.name, area.bbox, osm_path(area))]
+    size = config.osm_tile_size
+    return [(f"tile {key}", tile_bbox(key, size), tile_path(osm_date(), size, key)) for key in area_tiles(area.polygon, size)]
+
+def fetch_osm_data(config, areas, refresh=False):
+    """Gets OSM data for all areas that don't have any yet, as many at the same time as Overpass allows"""
+    missing = {}
+    for area in areas:
+        for job in osm_jobs(config, area):
+            if refresh or not find_osm_file(job[2]):
+                # Tiles shared by several areas are only fetched once
+                missing[job[2]] = job
+    if missing:
+        log.info(f"Getting {len(missing)} OSM files for {len(areas)} areas")
+        if config.osm_tile_size > 0:
+            os.makedirs(tile_dir(osm_date(), config.osm_tile_size), exist_ok=True)
+        get_osm_data(config, list(missing.values()), osm_date())
+
+def parks_outside(osm, area, area_file_data):
+    """
+    Ways and relations (their positions in osm.ways and osm.relations) whose nodes' bounding box doesn't touch
+    the geofence, so they can't be in it. Found from the node coordinates alone, before any polygon is built.
+    Connected parks are always built, since they get merged with others.
+    """
+    way_bounds = osm.way_bounds()
+    way_rows = {way_id: i for i, way_id in enumerate(osm.way_ids.tolist())}
+    relation_bounds = np.full((len(osm.relations), 4), np.nan)
+    for i, relation in enumerate(osm.relations):
+        # The same members RelPark.get_polygon uses
+        rows = [way_rows[m["ref"]] for m in relation["members"] if m["type"] != "node" and m["ref"] in way_rows]
+        if rows:
+            bounds = way_bounds[rows]
+            relation_bounds[i] = [bounds[:, 0].min(), bounds[:, 1].min(), bounds[:, 2].max(), bounds[:, 3].max()]
+
+    connected = set()
+    for osm_id, data in area_file_data.items():
+        if data.get("connect"):
+            connected.add(osm_id)
+            connected.update(data["connect"])
+
+    outside = boxes_outside(area.polygon, np.vstack([way_bounds, relation_bounds])).tolist()
+    way_ids = osm.way_ids.tolist()
+    return (
+        {i for i, out in enumerate(outside[:len(way_ids)]) if out and way_ids[i] not in connected},
+        {i for i, out in enumerate(outside[len(way_ids):]) if out and osm.relations[i]["id"] not in connected}
+    )
+
+def build_parks(config, osm, area, area_file_data, failed_nests, pool, stats):
+    with stats.timer("prefilter"):
+        way_outside, relation_outside = parks_outside(osm, area, area_file_data)
+    # Their polygons are never built, so they count as not in the geofence even if their geometry
+    # isn't valid. "Geometry is not valid" is only counted for parks that pass this
+    failed_nests["Not in Geofence"] += len(way_outside) + len(relation_outside)
+
+    start = timeit.default_timer()
+    ways = [WayPark(element, config) for element in osm.ways]
+    relations = [RelPark(element, config) for element in osm.relations]
+
+    # Check Relations
+
+    way_index = {way.id: way for way in ways}
+    double_ways = set()
+    for i, park in enumerate(relations):
+        if i in relation_outside:
+            # Its ways still aren't nests on their own
+            double_ways.update(m["ref"] for m in park._element["members"] if m["type"] != "node" and m["ref"] in way_index)
+            continue
+        double_ways = park.get_polygon(osm, way_index, double_ways)
+    for i, park in enumerate(ways):
+        if i not in way_outside:
+            park.get_polygon(osm)
+
+    parks = [park for i, park in enumerate(ways) if i not in way_outside]
+    parks += [park for i, park in enumerate(relations) if i not in relation_outside]
+
+    stats.add_time("polygons", timeit.default_timer() - start)
+
+    with stats.timer("connect"):
+        parks = connect_parks(parks, area_file_data)
+
+    start = timeit.default_timer()
+    valid_parks = [park for park in parks if park.is_valid]
+    failed_nests["Geometry is not valid"] += len(parks) - len(valid_parks)
+
+    candidates = []
+    for park, in_fence in zip(valid_parks, in_geofence(area.polygon, valid_parks, pool)):
+        if not in_fence:
+            failed_nests["Not in Geofence"] += 1
+            continue
+
+        if park.id in double_ways:
+            failed_nests["Avoiding double nests"] += 1
+            continue
+
+        candidates.append(park)
+
+    stats.add_time("geofence", timeit.default_timer() - start)
+    return candidates
+
+def load_parks(config, area, area_file_data, park_workers, stats):
+    """
+    Returns (parks that could be nests, their centers, failed counts).
+    Parks are built from OSM data once and then read from a park cache next to the OSM file.
+    """
     # Getting OSM/overpass data
-    
-    osm_file_name = f"data/osm_data/{area.name} {OSM_DATE.replace(':', '')}.json"
-    try:
-        with open(osm_file_name, mode="r", encoding="utf-8") as osm_file:
-            nest_json = json.load(osm_file)
-    except:
-        nest_json = get_osm_data(area.bbox, OSM_DATE, osm_file_name)
 
+    osm_file_names = [file_name for _, _, file_name in osm_jobs(config, area)]
+    cache_file_name = park_cache_name(osm_path(area))
+    if all(find_osm_file(file_name) for file_name in osm_file_names):
+        memory = park_memory.get(area.name)
+        if memory is not None and memory["key"] == park_cache_key(osm_file_names, area, area_file_data, quick=True):
+            return memory["parks"]
+
+        with stats.timer("park cache"):
+            key = park_cache_key(osm_file_names, area, area_file_data)
+            cached = read_park_cache(cache_file_name, key, config)
+        if cached is not None:
+            log.info("Using cached park polygons")
+            remember_parks(config, area, osm_file_names, area_file_data, cached)
+            return cached
+
+    with stats.timer("osm load"):
+        fetch_osm_data(config, [area])
+        osm = merge_osm(osm_file_names)
+
+    log.info(f"Building park polygons for {area.name}")
+    failed_nests = defaultdict(int)
+    # One set of worker processes for both the geofence checks and the centers
+    with ParkPool(park_workers) as pool:
+        candidates = build_parks(config, osm, area, area_file_data, failed_nests, pool, stats)
+        with stats.timer("centers"):
+            centers = park_centers(candidates, pool)
+
+    osm_file_names = [file_name for file_name in osm_file_names if os.path.exists(file_name)]
+    with stats.timer("park cache"):
+        key = park_cache_key(osm_file_names, area, area_file_data)
+        write_park_cache(cache_file_name, key, candidates, centers, failed_nests)
+    remember_parks(config, area, osm_file_names, area_file_data, (candidates, centers, failed_nests))
+    return candidates, centers, failed_nests
+
+def remember_parks(config, area, osm_file_names, area_file_data, parks):
+    if config.daemon:
+        key = park_cache_key(osm_file_names, area, area_file_data, quick=True)
+        park_memory[area.name] = {"key": key, "parks": parks, "indexes": {}}
+
+def park_index(area, parks, shapes, kind):
+    """ParkIndex over shapes(park) of every park. Kept with the parks in daemon mode"""
+    memory = park_memory.get(area.name)
+    if memory is None or memory["parks"][0] is not parks:
+        return ParkIndex(parks, [shapes(park) for park in parks])
+    if kind not in memory["indexes"]:
+        memory["indexes"][kind] = ParkIndex(parks, [shapes(park) for park in parks])
+    return memory["indexes"][kind]
+
+def analyze_nests(config, area, nest_mons, queries, reset_time, nodelete):
     # Getting area data
 
     area_file_name = f"data/area_data/{area.name}.json"
@@ -50,104 +214,142 @@ def analyze_nests(config, area, nest_mons, queries, reset_time, nodelete):
     except FileNotFoundError:
         db_data = {}"""
     
-    if not nodelete:
-        queries.nest_delete(area.sql_fence, str(reset_time))
-
-    if config.poracle:
-        poracle_data = []
+    poracle_data = []
 
     log.info(f"Got all relevant information. Searching for nests in {area.name} now")
 
-    nodes = {}
-    ways = []
-    relations = []
-    for element in nest_json['elements']:
-        if not "type" in element:
-            continue
-        if element["type"] == "node":
-            nodes[element["id"]] = {
-                "lat": element["lat"],
-                "lon": element["lon"]
-            }
-        elif element["type"] == "way":
-            if "nodes" not in element and not element["nodes"]:
-                continue
-            ways.append(WayPark(element, config))
-        elif element["type"] == "relation":
-            if "members" not in element and not element["members"]:
-                continue
-            relations.append(RelPark(element, config))
-
-    parks = ways + relations
-
-    # Check Relations
-
     failed_nests = defaultdict(int)
     failed_nests["Total Nests found"] = 0
-    double_ways = []
+    queries.set_run(nest_mons, reset_time)
+    stats = RunStats(area.name)
+    queries.stats = stats
 
     start = timeit.default_timer()
 
-    if config.less_queries:
-        log.info("Getting DB data")
-        all_spawns = [(str(_id), geometry.Point(lon, lat)) for _id, lat, lon in queries.spawns(area.sql_fence)]
-        all_mons = queries.all_mons(str(tuple(nest_mons)), str(reset_time), area.sql_fence)
-        all_mons = [(_id, geometry.Point(lon, lat)) for _id, lat, lon in all_mons]
-    
-    with Progress() as progress:
-        #check_rels_task = progress.add_task("Generating Polygons", total=len(parks))
-        for park in relations:
-            double_ways = park.get_polygon(nodes, ways, double_ways)
-            #progress.update(check_rels_task, advance=1)
-        for park in ways:
-            park.get_polygon(nodes)
-            #progress.update(check_rels_task, advance=1)
-
-        for osm_id, data in area_file_data.items():
-            for connect_id in data["connect"]:
-                for i, park in enumerate(parks):
-                    if park.id == osm_id:
-                        big_park = park
-                        big_park_i = i
-                    if park.id == connect_id:
-                        small_park = park
-                        small_park_i = i
-
-                parks[big_park_i].connect.append(connect_id)
-                parks[big_park_i].polygon = cascaded_union([big_park.polygon, small_park.polygon])
-                parks.pop(small_park_i)
+    # Park workers can't be started from inside an area worker
+    park_workers = config.park_workers if config.workers <= 1 else 1
+
+    candidates, centers, failed_parks = load_parks(config, area, area_file_data, park_workers, stats)
+    for k, v in failed_parks.items():
+        failed_nests[k] += v
+
+    def query_stops(park):
+        if not config.pokestop_pokemon:
+            return []
+        # Get all Pokestops with id, lat and lon
+        return [str(pkstp[0]) for pkstp in queries.stops(park.sql_fence)]
+
+    # Progress bars of several worker processes would just garble each other
+    with Progress(disable=config.workers > 1) as progress:
+        stage_start = timeit.default_timer()
+        if config.bulk_queries:
+            # Load everything for the area once and assign it to parks in memory
+            log.info("Getting DB data")
+            index = park_index(area, candidates, fence_polygon, "fence")
+            bounds = area.polygon.bounds
+
+            # Only sightings newer than the last run are needed if there are stored counts to add them to
+            state = None
+            settle_time = None
+            if config.incremental:
+                state = load_state(config, area, nest_mons, reset_time)
+            since = None if state is None else state[0]
+            if config.incremental:
+                # Stored sightings are everything before the watermark, so it never goes back, not even before the migration
+                settle_time = max(queries.db_time() - SETTLE_TIME, since or reset_time)
+
+            # With pre_aggregate the DB sends one row per spawnpoint/pokestop and mon instead of every sighting
+            mon_query = queries.bbox_mon_counts if config.pre_aggregate else queries.bbox_mons
+            # The DB counts mons itself with set_queries
+            stop_rows, spawn_rows, mon_batches = queries.gather(
+                lambda: queries.bbox_stops(bounds) if config.pokestop_pokemon else [],
+                lambda: queries.bbox_spawns(bounds),
+                lambda: [] if config.set_queries else mon_query(bounds, since, settle_time)
+            )
+
+            stop_ids, lat, lon = columns(stop_rows)
+            stop_members = (stop_ids, *index.assign(lat, lon))
+            park_stops = index.members(*stop_members)
+
+            spawn_ids, lat, lon = columns(spawn_rows)
+            spawn_members = (spawn_ids, *index.assign(lat, lon))
+            park_spawns = index.members(*spawn_members)
+
+            if config.set_queries:
+                # The DB counts mons for all parks at once and only sends back the winners
+                rows = queries.park_mons(member_rows(spawn_members), member_rows(stop_members))
+                park_mons = {candidates[park_id]: (mon_id, count) for park_id, mon_id, count in rows}
 
-        # NOW CHECK ALL AREAS ONE AFTER ANOTHER
-        check_nest_task = progress.add_task("Nests found: 0", total=len(parks))
-        nests = []
+            else:
+                # Sightings are grouped batch by batch, so only one batch of rows is ever kept around
+                settled, recent = sighting_groups([])
+                for mon_rows in mon_batches:
+                    batch_settled, batch_recent = sighting_groups(mon_rows)
+                    settled = merge_groups(settled, batch_settled)
+                    recent = merge_groups(recent, batch_recent)
+                if state is not None:
+                    log.info("Adding new sightings to the stored nest state")
+                    settled = merge_groups(state[1], settled)
+                if config.incremental:
+                    # Recent sightings aren't stored, they're read again next run with any that came in late
+                    save_state(config, area, nest_mons, reset_time, settle_time, settled)
+                groups = merge_groups(settled, recent)
+
+                park_mons = top_mons(candidates, groups, spawn_members, stop_members)
+
+        elif config.less_queries:
+            log.info("Getting DB data")
+            index = park_index(area, candidates, lambda park: park.polygon, "polygon")
+            spawn_rows, mon_batches = queries.gather(
+                lambda: queries.spawns(area.sql_fence),
+                lambda: queries.all_mons(area.sql_fence)
+            )
+
+            spawn_ids, lat, lon = columns(spawn_rows)
+            park_spawns = index.members(spawn_ids, *index.assign(lat, lon))
+
+            mon_counts = count_mons([], [])
+            for mon_rows in mon_batches:
+                mon_ids, lat, lon = columns(mon_rows, int)
+                point_idx, park_idx = index.assign(lat, lon)
+                mon_counts = merge_counts(mon_counts, count_mons(park_idx, mon_ids[point_idx]))
+            park_mons = index.top_mons(*mon_counts)
+            park_results = queries.map(query_stops, candidates)
+
+        else:
+            def park_data(park):
+                # Everything the DB knows about one park. Runs for several parks at a time with a connection pool
+                stops = query_stops(park)
+                spawns = [str(s[0]) for s in queries.spawns(park.sql_fence)]
 
-        for park in parks:
-            progress.update(check_nest_task, advance=1, description=f"Nests found: {failed_nests['Total Nests found']}")
+                # Parks that fail the checks below don't need their mons counted
+                poke_data = None
+                if stops or (spawns and len(spawns) >= area.settings['min_spawnpoints']):
+                    poke_data = queries.mons(spawns, stops)
+                return stops, spawns, poke_data
 
-            if not park.is_valid:
-                failed_nests["Geometry is not valid"] += 1
-                continue
+            park_results = queries.map(park_data, candidates)
 
-            if not area.polygon.contains(park.polygon):
-                failed_nests["Not in Geofence"] += 1
-                continue
+        stats.add_time("mon counting", timeit.default_timer() - stage_start)
 
-            if park.id in double_ways:
-                failed_nests["Avoiding double nests"] += 1
-                continue
+        # NOW CHECK ALL AREAS ONE AFTER ANOTHER
+        stage_start = timeit.default_timer()
+        check_nest_task = progress.add_task("Nests found: 0", total=len(candidates))
+        nests = []
 
-            pokestop_in = None
-            stops = []
-            if config.pokestop_pokemon:
-                # Get all Pokestops with id, lat and lon
-                for pkstp in queries.stops(park.sql_fence):
-                    stops.append(str(pkstp[0]))
-                pokestop_in = "'{}'".format("','".join(stops))
+        for park in candidates:
+            progress.update(check_nest_task, advance=1, description=f"Nests found: {failed_nests['Total Nests found']}")
 
-            if config.less_queries:
-                spawns = [s[0] for s in all_spawns if park.polygon.contains(s[1])]
+            if config.bulk_queries:
+                stops = park_stops.get(park, [])
+                spawns = park_spawns.get(park, [])
+                poke_data = park_mons.get(park)
+            elif config.less_queries:
+                stops = next(park_results)
+                spawns = park_spawns.get(park, [])
+                poke_data = park_mons.get(park)
             else:
-                spawns = [str(s[0]) for s in queries.spawns(park.sql_fence)]
+                stops, spawns, poke_data = next(park_results)
 
             if not stops and not spawns:
                 failed_nests["No Stops or Spawnpoints"] += 1
@@ -155,23 +357,9 @@ def analyze_nests(config, area, nest_mons, queries, reset_time, nodelete):
             if (len(stops) < 1) and (len(spawns) < area.settings['min_spawnpoints']):
                 failed_nests["Not enough Spawnpoints"] += 1
                 continue
-            spawnpoint_in = "'{}'".format("','".join(spawns))
-            if spawnpoint_in == "''": spawnpoint_in = "NULL" # This will handle the SQL warning since a blank string shouldn't be used for a number
-
-            if config.less_queries:
-                mons = [s[0] for s in all_mons if park.polygon.contains(s[1])]
-                if len(mons) == 0:
-                    failed_nests["No Pokemon"] += 1
-                    continue
-                most_id = max(set(mons), key=mons.count)
-                poke_data = [most_id, mons.count(most_id)]
-
-            else:
-                poke_data = queries.mons(spawnpoint_in, str(tuple(nest_mons)), str(reset_time), pokestop_in)
-
-                if poke_data is None:
-                    failed_nests["No Pokemon"] += 1
-                    continue
+            if poke_data is None:
+                failed_nests["No Pokemon"] += 1
+                continue
             park.mon_data(poke_data[0], poke_data[1], area.settings['scan_hours_per_day'], len(spawns) + len(stops))
 
             if park.mon_count < area.settings['min_pokemon']:
@@ -184,8 +372,15 @@ def analyze_nests(config, area, nest_mons, queries, reset_time, nodelete):
                 failed_nests["Average spawn ratio too low"] += 1
                 continue
 
+            failed_nests["Total Nests found"] += 1
+            nests.append(park)
+
+        stats.add_time("classification", timeit.default_timer() - stage_start)
+        stage_start = timeit.default_timer()
+        nest_rows = []
+        for nr, park in enumerate(nests):
             try:
-                park.generate_details(area_file_data, failed_nests["Total Nests found"])
+                park.generate_details(area_file_data, nr, centers.get(park))
             except TopologicalError:
                 failed_nests["Geometry is not valid"] += 1
 
@@ -207,17 +402,17 @@ def analyze_nests(config, area, nest_mons, queries, reset_time, nodelete):
                 "nest_submitted_by": config.submitted_by
             }
 
-            failed_nests["Total Nests found"] += 1
-            nests.append(park)
-
-            queries.nest_insert(insert_args)
+            nest_rows.append(insert_args)
 
             if config.poracle:
-                insert_args["reset_time"] = int(reset_time)
                 poracle_data.append({
                     "type": "nest",
-                    "message": insert_args
+                    "message": dict(insert_args, reset_time=int(reset_time))
                 })
+
+        stats.add_time("details", timeit.default_timer() - stage_start)
+        with stats.timer("insert"):
+            queries.nest_write(area.sql_fence, nest_rows, not nodelete)
     stop = timeit.default_timer()
     log.success(f"Done finding nests in {area.name} ({round(stop - start, 1)} seconds)")
     for k, v in failed_nests.items():
@@ -226,6 +421,7 @@ def analyze_nests(config, area, nest_mons, queries, reset_time, nodelete):
     def sort_avg(nest):
         return nest.mon_avg
 
+    stage_start = timeit.default_timer()
     new_area_data = {}
     for nest in sorted(nests, key=sort_avg, reverse=True):
         new_area_data[nest.id] = {
@@ -244,11 +440,27 @@ def analyze_nests(config, area, nest_mons, queries, reset_time, nodelete):
         area_file.write(json.dumps(new_area_data, indent=4))
 
         log.info("Saved area data")
+    stats.add_time("area data write", timeit.default_timer() - stage_start)
 
-    if config.poracle:
-        for endpoint in config.poracle:
-            r = requests.post(endpoint, json=poracle_data)
-            log.info(f"Sent data to Poracle with status code {r.status_code}")
     log.success(f"All done with {area.name}\n")
 
-    return nests
\ No newline at end of file
+    return nests, poracle_data, stats.report(failed_nests, len(nests))
+
+def analyze_area(config, area, nest_mons, reset_time, nodelete):
+    # Runs in a worker process, which needs its own DB connections
+    global worker_queries
+    if worker_queries is None:
+        worker_queries = Queries(config)
+    else:
+        worker_queries.ping()
+    try:
+        return profiled(config.profile, area.name, analyze_nests, config, area, nest_mons, worker_queries, reset_time, nodelete)
+    finally:
+        if not config.daemon:
+            worker_queries.close()
+            worker_queries = None
+
+def send_poracle(config, poracle_data):
+    for endpoint in config.poracle:
+        r = requests.post(endpoint, json=poracle_data)
+        log.info(f"Sent data to Poracle with status code {r.status_code}")
\ No newline at end of file
@@ -39,6 +39,13 @@ def get_zoom(ne, sw, width, height, tile_size):
 
     return min(lat_zoom, lon_zoom)
 
+def get_center(polygon):
+    if isinstance(polygon, geometry.MultiPolygon):
+        center_point = polygon.centroid
+    else:
+        center_point = polylabel(polygon, tolerance=1e-6)
+    return round(center_point.y, 6), round(center_point.x, 6)
+
 class Area():
     def __init__(self, area, settings={}):
         self.name = area["name"]
@@ -274,6 +281,12 @@ class Park():
 
         self.is_valid = True
 
+    def set_geometry(self, polygon, path):
+        # Used for parks that come out of the park cache
+        self.polygon = polygon
+        self.path = path
+        self.sql_fence = ",".join("(" + ",".join(f"{lat} {lon}" for lat, lon in p) + ")" for p in path)
+
     def mon_data(self, mid, amount, hours, spawns):
         self.mon_id = mid
         self.mon_count = amount
@@ -282,7 +295,7 @@ class Park():
                     24.00 / float(self._config.hours_since_change)), 2)
         self.mon_ratio = self.mon_avg / spawns
 
-    def generate_details(self, area_file, nr):
+    def generate_details(self, area_file, nr, center=None):
         if self.id in area_file.keys():
             entry = area_file[self.id]
             self.name = entry["name"]
@@ -293,12 +306,10 @@ class Park():
             self.name = tags.get("name", tags.get("official_name", self._default_name.format(nr=nr)))
             # get name. if not there, get official name. if not there, use default name
 
-            if isinstance(self.polygon, geometry.MultiPolygon):
-                center_point = self.polygon.centroid
-            else:
-                center_point = polylabel(self.polygon, tolerance=1e-6)
-            self.lat = round(center_point.y, 6)
-            self.lon = round(center_point.x, 6)
+            # center may already be calculated by a park worker
+            if center is None:
+                center = get_center(self.polygon)
+            self.lat, self.lon = center
 
         self.get_feature()
 
@@ -329,10 +340,8 @@ class WayPark(Park):
         super().__init__(element, config)
     
     def get_polygon(self, nodes):
-        way_points = list()
-        for point in self._element['nodes']:
-            point_coords = nodes[point]
-            way_points.append([point_coords['lon'], point_coords['lat']])
+        # nodes is an OSMData
+        way_points = nodes.points(self._element['nodes'])
         if len(way_points) < 3:
             self.is_valid = False
             return
@@ -351,23 +360,19 @@ class RelPark(Park):
         super().__init__(element, config)
 
     def get_polygon(self, nodes, ways, new_ways):
+        # nodes is an OSMData, ways a dict of way id -> WayPark, new_ways a set of ways that are used by relations
         inner_members = list()
         outer_members = list()
         for member in self._element["members"]:
             if member["type"] == "node":
                 continue
             
-            way = [w for w in ways if w.id == member["ref"]]
-            if way == []:
+            way = ways.get(member["ref"])
+            if way is None:
                 continue
-            else:
-                way = way[0]
-            new_ways.append(way.id)
+            new_ways.add(way.id)
 
-            area_points = list()
-            for point in way._element["nodes"]:
-                point_coords = nodes[point]
-                area_points.append([point_coords['lon'], point_coords['lat']])
+            area_points = nodes.points(way._element["nodes"])
 
             way_poly = geometry.LineString(area_points)
 
@@ -0,0 +1,63 @@
+import os
+import json
+import mmap
+import struct
+
+from contextlib import contextmanager
+
+# Binary files of nestwatcher (OSM data, park caches): MAGIC, header length (uint64), JSON header,
+# blob of 8 byte aligned data. Reading one is an mmap and parsing the header, everything in the blob stays on disk
+
+@contextmanager
+def atomic_write(file_name, mode="w", encoding=None):
+    """
+    Opens a temporary file that replaces file_name once it's written, so readers never see half a file.
+    Not even after a crash
+    """
+    tmp_name = file_name + ".tmp"
+    try:
+        with open(tmp_name, mode=mode, encoding=encoding) as f:
+            yield f
+    except BaseException:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise
+    os.replace(tmp_name, file_name)
+
+def append_aligned(blob, data):
+    """Adds data to a blob bytearray, padded to 8 bytes. Returns its offset in the blob"""
+    offset = len(blob)
+    blob.extend(data)
+    blob.extend(b"\0" * (-len(blob) % 8))
+    return offset
+
+def write_binfile(file_name, magic, header, blob):
+    header = json.dumps(header).encode("utf-8")
+    # Padded so the blob starts 8 byte aligned too
+    header += b" " * (-(len(magic) + 8 + len(header)) % 8)
+    with atomic_write(file_name, mode="wb") as f:
+        f.write(magic)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        f.write(blob)
+
+def read_binfile(file_name, magic):
+    """
+    Returns (header, mmap of the file, where the blob starts in it).
+    Raises ValueError if it isn't a file with that magic or it's cut off
+    """
+    with open(file_name, mode="rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size <= len(magic) + 8:
+            raise ValueError(f"{file_name} is too short")
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if data[:len(magic)] != magic:
+        raise ValueError(f"{file_name} doesn't start with {magic!r}")
+    header_length, = struct.unpack_from("<Q", data, len(magic))
+    blob_start = len(magic) + 8 + header_length
+    if blob_start > size:
+        raise ValueError(f"{file_name} is cut off")
+    # JSONDecodeError and UnicodeDecodeError are ValueErrors too
+    header = json.loads(data[len(magic) + 8:blob_start])
+    return header, data, blob_start
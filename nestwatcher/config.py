@@ -6,10 +6,16 @@ class Config:
         config_file.read(config_path)
 
         self.hours_since_change = 3
+        self.profile = False
+        self.daemon = False
         self.auto_time = config_file.getboolean("Config", "auto_time", fallback=True)
         self.use_events = config_file.getboolean("Config", "events", fallback=True)
         self.hemisphere = config_file.get("Config", "hemisphere", fallback="all")
         self.less_queries = config_file.getboolean("Config", "less_queries", fallback=False)
+        self.bulk_queries = config_file.getboolean("Config", "bulk_queries", fallback=False)
+        self.incremental = config_file.getboolean("Config", "incremental", fallback=False)
+        self.set_queries = config_file.getboolean("Config", "set_queries", fallback=False)
+        self.pre_aggregate = config_file.getboolean("Config", "pre_aggregate", fallback=False)
         self.submitted_by = config_file.get("Config", "bot_name", fallback=None)
         if not self.submitted_by:
             self.submitted_by = None
@@ -18,7 +24,10 @@ class Config:
         self.poracle = config_file.get("Config", "poracle_endpoint", fallback=False)
         if self.poracle:
             self.poracle = self.poracle.split(",")
-        self.workers = 5
+        self.workers = config_file.getint("Config", "workers", fallback=1)
+        self.park_workers = config_file.getint("Config", "park_workers", fallback=1)
+        self.run_report = config_file.get("Config", "run_report", fallback="")
+        self.prometheus_file = config_file.get("Config", "prometheus_file", fallback="")
 
         self.scanner = config_file.get("Scanner DB", "scanner")
         self.db_name = config_file.get("Scanner DB", "name")
@@ -27,12 +36,21 @@ class Config:
         self.db_host = config_file.get("Scanner DB", "host")
         self.db_port = config_file.getint("Scanner DB", "port")
         self.custom_pokemon = config_file.get("Scanner DB", "custom_pokemon_table", fallback="pokemon")
+        self.db_pool_size = config_file.getint("Scanner DB", "pool_size", fallback=1)
+        self.stream_batch_size = config_file.getint("Scanner DB", "stream_batch_size", fallback=0)
+
+        self.overpass_url = config_file.get("Overpass", "url", fallback="https://overpass.kumi.systems/api/interpreter")
+        self.overpass_status_url = config_file.get("Overpass", "status_url", fallback="http://overpass-api.de/api/status")
+        self.overpass_concurrency = config_file.getint("Overpass", "concurrency", fallback=2)
+        self.overpass_fixtures = config_file.get("Overpass", "fixtures", fallback="")
+        self.osm_tile_size = config_file.getfloat("Overpass", "tile_size", fallback=0.25)
 
         self.nest_db_name = config_file.get("Nest DB", "name")
         self.nest_db_user = config_file.get("Nest DB", "user")
         self.nest_db_password = config_file.get("Nest DB", "password")
         self.nest_db_host = config_file.get("Nest DB", "host")
         self.nest_db_port = config_file.getint("Nest DB", "port")
+        self.nest_batch_size = max(1, config_file.getint("Nest DB", "batch_size", fallback=500))
 
         self.default_park_name = config_file.get("Geojson", "default_park_name")
         self.json_path = config_file.get("Geojson", "path")
@@ -46,4 +64,5 @@ class Config:
         self.language = config_file.get("Discord", "language")
         self.static_url = config_file.get("Discord", "tileserver_url")
         self.icon_repo = config_file.get("Discord", "icon_repo")
-        self.time_format = config_file.get("Discord", "time_format", fallback="%d.%m. %H:%M")
\ No newline at end of file
+        self.time_format = config_file.get("Discord", "time_format", fallback="%d.%m. %H:%M")
+        self.webhook_concurrency = config_file.getint("Discord", "webhook_concurrency", fallback=4)
\ No newline at end of file
@@ -0,0 +1,67 @@
+from collections import defaultdict
+from shapely.ops import unary_union
+
+from nestwatcher.logging import log
+
+class UnionFind():
+    def __init__(self):
+        self.parents = {}
+
+    def find(self, item):
+        self.parents.setdefault(item, item)
+        root = item
+        while self.parents[root] != root:
+            root = self.parents[root]
+        while self.parents[item] != root:
+            self.parents[item], item = root, self.parents[item]
+        return root
+
+    def union(self, item, other):
+        self.parents[self.find(other)] = self.find(item)
+
+def connect_parks(parks, area_file_data):
+    """
+    Merges parks that are connected through area_data into one park per group, with a single union of all
+    their polygons. The park that stays is the first one with connects that isn't connected to another park
+    itself. Connect ids that aren't in the OSM data are reported and skipped.
+    """
+    index = {park.id: park for park in parks}
+    groups = UnionFind()
+    owners = []
+    missing = []
+    for osm_id, data in area_file_data.items():
+        if not data["connect"]:
+            continue
+        if osm_id not in index:
+            missing.append(osm_id)
+            continue
+        for connect_id in data["connect"]:
+            if connect_id not in index:
+                missing.append(connect_id)
+                continue
+            if connect_id == osm_id:
+                continue
+            groups.union(osm_id, connect_id)
+            index[osm_id].connect.append(connect_id)
+        owners.append(osm_id)
+
+    if missing:
+        log.warning(f"Couldn't find these connected parks in the OSM data: {', '.join(str(m) for m in missing)}")
+
+    members = defaultdict(list)
+    for osm_id in groups.parents:
+        members[groups.find(osm_id)].append(osm_id)
+    group_owners = defaultdict(list)
+    for osm_id in owners:
+        if osm_id in groups.parents:
+            group_owners[groups.find(osm_id)].append(osm_id)
+    connected = {connect_id for osm_id in owners for connect_id in index[osm_id].connect}
+
+    merged_away = set()
+    for root, group in members.items():
+        candidates = [osm_id for osm_id in group_owners[root] if osm_id not in connected] or group_owners[root]
+        big_park = index[candidates[0]]
+        big_park.polygon = unary_union([index[osm_id].polygon for osm_id in group if index[osm_id].polygon is not None])
+        merged_away.update(index[osm_id] for osm_id in group if osm_id != big_park.id)
+
+    return [park for park in parks if park not in merged_away]
@@ -1,7 +1,11 @@
+import asyncio
+import aiohttp
 import discord
 import requests
 import json
 
+from collections import defaultdict
+
 from nestwatcher.logging import log
 
 def existing_emotes(guilds, emote_name):
@@ -59,3 +63,111 @@ async def get_emotes(bot, nesting_mons, config):
         final_emotes[int(monid)] = emoji.id
     
     return final_emotes
+
+def webhook_embeds(embed_dict, entry_list):
+    """Splits a nest message into as many embeds as needed to stay below Discord's description limit"""
+    entry_list_2 = []
+    entries = []
+
+    text = ""
+    while len(entry_list) > 0:
+        text = ""
+        for entry in entry_list:
+            if len(entry+text) > 2048:
+                entries.append(text)
+                break
+            text += entry
+            entry_list_2.append(entry)
+        entry_list = [e for e in entry_list if e not in entry_list_2]
+    if text and text not in entries:
+        entries.append(text)
+
+    embeds = []
+    for i, entry in enumerate(entries):
+        embed = {
+            "description": entry
+        }
+        keys = ["color"]
+        if i == 0:
+            keys += ["title", "url", "thumbnail", "author"]
+        if i == len(entries) - 1:
+            keys += ["timestamp", "footer", "image"]
+        for key in keys:
+            if key in embed_dict.keys():
+                embed[key] = embed_dict[key]
+        embeds.append(embed)
+    return embeds
+
+async def send_nest_messages(bot, message_data, emote_refs, config, last_regular_migration):
+    # message_data are [channel id, area] pairs. Existing nest messages of the bot are edited
+    for d, area in message_data:
+        try:
+            channel = await bot.fetch_channel(d)
+            found = False
+            embed_dict, _ = area.get_nest_text(config, emote_refs, last_regular_migration, config.time_format)
+            embed = discord.Embed().from_dict(embed_dict)
+            async for message in channel.history():
+                if message.author == bot.user:
+                    embeds = message.embeds
+                    if len(embeds) > 0:
+                        if embeds[0].title == embed.title:
+                            found = True
+                            break
+            if found:
+                log.success(f"Found existing Nest message for {area.name} and editing it")
+                await message.edit(embed=embed)
+            else:
+                log.success(f"Sending a new Nest message for {area.name}")
+                await channel.send(embed=embed)
+        except Exception as e:
+            log.exception(e)
+
+async def retry_seconds(r):
+    """Seconds to wait after a 429. Retry-After is in seconds, the body's retry_after too on current API versions"""
+    try:
+        if r.headers.get("Retry-After"):
+            return float(r.headers["Retry-After"])
+        # Might not be JSON at all, e.g. an HTML page of Cloudflare
+        return float((await r.json(content_type=None)).get("retry_after", 1))
+    except (ValueError, TypeError, AttributeError, aiohttp.ClientError):
+        return 1.0
+
+async def post_webhook(session, url, payload, retries=5):
+    """Posts to a webhook, waiting out rate limits. Returns the last status code"""
+    for _ in range(retries):
+        async with session.post(url, json=payload) as r:
+            if r.status == 429:
+                retry_after = await retry_seconds(r)
+                log.warning(f"Webhook is rate limited. Retrying in {retry_after} seconds")
+                await asyncio.sleep(retry_after)
+                continue
+            # The bucket is empty, so the next message would only get a 429
+            if r.headers.get("X-RateLimit-Remaining") == "0":
+                await asyncio.sleep(float(r.headers.get("X-RateLimit-Reset-After", 1)))
+            return r.status
+    return 429
+
+async def send_webhooks(webhooks, concurrency):
+    """
+    webhooks are (url, area name, embeds). Messages to the same webhook are sent one after another and in order,
+    different webhooks are sent to at the same time, up to concurrency of them.
+    """
+    if not webhooks:
+        return
+    by_url = defaultdict(list)
+    for url, name, embeds in webhooks:
+        by_url[url].append((name, embeds))
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def send(session, url, areas):
+        async with semaphore:
+            for name, embeds in areas:
+                for embed in embeds:
+                    try:
+                        status = await post_webhook(session, url, {"embeds": [embed]})
+                        log.success(f"Sent Webhook for {name} ({status})")
+                    except aiohttp.ClientError as e:
+                        log.error(f"Couldn't send Webhook for {name}: {e}")
+
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*[send(session, url, areas) for url, areas in by_url.items()])
@@ -0,0 +1,195 @@
+import os
+import numpy as np
+
+from array import array
+
+from nestwatcher.binfile import append_aligned, read_binfile, write_binfile
+from nestwatcher.logging import log
+from nestwatcher.osmjson import stream_file
+
+# A binfile with little endian arrays in the blob. The header has way tags, relations and where each array is,
+# so loading is one mmap and no parsing of nodes
+MAGIC = b"NWOSM001"
+ARRAYS = {
+    "node_ids": "<i8",
+    "node_coords": "<f8",
+    "way_ids": "<i8",
+    "way_offsets": "<i8",
+    "way_nodes": "<i8"
+}
+
+class OSMData():
+    """
+    Nodes, ways and relations of an Overpass result. Node coordinates are [lat, lon] rows sorted by node id,
+    the nodes of way i are way_nodes[way_offsets[i]:way_offsets[i + 1]].
+    """
+    def __init__(self, node_ids, node_coords, way_ids, way_offsets, way_nodes, way_tags, relations):
+        self.node_ids = node_ids
+        self.node_coords = node_coords
+        self.way_ids = way_ids
+        self.way_offsets = way_offsets
+        self.way_nodes = way_nodes
+        self.way_tags = way_tags
+        self.relations = relations
+        self._ways = None
+
+    @property
+    def empty(self):
+        return len(self.node_ids) == 0 and len(self.way_ids) == 0 and len(self.relations) == 0
+
+    @property
+    def ways(self):
+        # Way elements like Overpass' JSON has them, with node ids as a view into way_nodes
+        if self._ways is None:
+            offsets = self.way_offsets.tolist()
+            self._ways = [
+                {"type": "way", "id": way_id, "nodes": self.way_nodes[offsets[i]:offsets[i + 1]], "tags": tags}
+                for i, (way_id, tags) in enumerate(zip(self.way_ids.tolist(), self.way_tags))
+            ]
+        return self._ways
+
+    def way_bounds(self):
+        """[min lat, min lon, max lat, max lon] of every way's nodes. NaN for ways without nodes or with unknown ones"""
+        bounds = np.full((len(self.way_ids), 4), np.nan)
+        has_nodes = np.diff(self.way_offsets) > 0
+        if len(self.node_ids) == 0 or not has_nodes.any():
+            return bounds
+        index = np.minimum(np.searchsorted(self.node_ids, self.way_nodes), len(self.node_ids) - 1)
+        coords = self.node_coords[index]
+        coords[self.node_ids[index] != self.way_nodes] = np.nan
+        # Ways without nodes have no rows, so the next way with nodes starts where they'd start
+        starts = self.way_offsets[:-1][has_nodes]
+        bounds[has_nodes, :2] = np.minimum.reduceat(coords, starts, axis=0)
+        bounds[has_nodes, 2:] = np.maximum.reduceat(coords, starts, axis=0)
+        return bounds
+
+    def points(self, node_ids):
+        """[lon, lat] of the given nodes"""
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        index = np.searchsorted(self.node_ids, node_ids)
+        found = index < len(self.node_ids)
+        if not found.all() or not np.array_equal(self.node_ids[index], node_ids):
+            missing = node_ids[~found] if not found.all() else node_ids[self.node_ids[index] != node_ids]
+            raise KeyError(int(missing[0]))
+        return self.node_coords[index][:, ::-1]
+
+class OSMBuilder():
+    """Collects elements one at a time (e.g. from an osmjson.ElementStream) into the arrays of an OSMData"""
+    def __init__(self):
+        self.node_ids = array("q")
+        self.node_coords = array("d")
+        self.way_ids = array("q")
+        self.way_offsets = array("q", [0])
+        self.way_nodes = array("q")
+        self.way_tags = []
+        self.relations = {}
+        self._ways = set()
+
+    def add(self, element):
+        element_type = element.get("type")
+        if element_type == "node":
+            self.node_ids.append(element["id"])
+            self.node_coords.extend((element["lat"], element["lon"]))
+        elif element_type == "way":
+            # Overpass returns a way or relation with all its members for every tile it touches,
+            # so elements that cross tile borders are only kept once
+            if element["id"] in self._ways:
+                return
+            self._ways.add(element["id"])
+            nodes = element.get("nodes", [])
+            if isinstance(nodes, np.ndarray):
+                self.way_nodes.frombytes(nodes.astype(np.int64).tobytes())
+            else:
+                self.way_nodes.extend(nodes)
+            self.way_ids.append(element["id"])
+            self.way_offsets.append(len(self.way_nodes))
+            self.way_tags.append(element.get("tags", {}))
+        elif element_type == "relation":
+            self.relations.setdefault(element["id"], {
+                "type": "relation",
+                "id": element["id"],
+                "members": element.get("members", []),
+                "tags": element.get("tags", {})
+            })
+
+    def add_data(self, osm):
+        self.node_ids.frombytes(osm.node_ids.astype(np.int64).tobytes())
+        self.node_coords.frombytes(osm.node_coords.astype(np.float64).tobytes())
+        for way in osm.ways:
+            self.add(way)
+        for relation in osm.relations:
+            self.add(relation)
+
+    def build(self):
+        node_ids = np.frombuffer(self.node_ids, dtype=np.int64)
+        node_coords = np.frombuffer(self.node_coords, dtype=np.float64).reshape(-1, 2)
+        # Sorted by id, the first of duplicate nodes wins
+        node_ids, first = np.unique(node_ids, return_index=True)
+        return OSMData(
+            node_ids,
+            node_coords[first],
+            np.frombuffer(self.way_ids, dtype=np.int64),
+            np.frombuffer(self.way_offsets, dtype=np.int64),
+            np.frombuffer(self.way_nodes, dtype=np.int64),
+            self.way_tags,
+            list(self.relations.values())
+        )
+
+def from_json(nest_json):
+    builder = OSMBuilder()
+    for element in nest_json.get("elements", []):
+        builder.add(element)
+    return builder.build()
+
+def merge(osm_datas):
+    """One OSMData out of several, with every node, way and relation only once"""
+    if len(osm_datas) == 1:
+        return osm_datas[0]
+    builder = OSMBuilder()
+    for osm in osm_datas:
+        builder.add_data(osm)
+    return builder.build()
+
+def write_osm(file_name, osm):
+    blob = bytearray()
+    arrays = {}
+    for name, dtype in ARRAYS.items():
+        data = np.ascontiguousarray(getattr(osm, name), dtype=dtype).tobytes()
+        arrays[name] = [append_aligned(blob, data), len(data)]
+    write_binfile(file_name, MAGIC, {"way_tags": osm.way_tags, "relations": osm.relations, "arrays": arrays}, blob)
+
+def read_osm(file_name):
+    header, data, blob_start = read_binfile(file_name, MAGIC)
+
+    arrays = {}
+    for name, dtype in ARRAYS.items():
+        offset, length = header["arrays"][name]
+        arrays[name] = np.frombuffer(data, dtype=dtype, count=length // 8, offset=blob_start + offset)
+    return OSMData(
+        arrays["node_ids"],
+        arrays["node_coords"].reshape(-1, 2),
+        arrays["way_ids"],
+        arrays["way_offsets"],
+        arrays["way_nodes"],
+        header["way_tags"],
+        header["relations"]
+    )
+
+def json_name(file_name):
+    return file_name.rsplit(".", 1)[0] + ".json"
+
+def convert_osm(json_file_name, file_name):
+    """Converts an OSM file of older versions (Overpass' JSON) to the binary format"""
+    builder = OSMBuilder()
+    stream_file(json_file_name, builder.add)
+    write_osm(file_name, builder.build())
+
+def find_osm_file(file_name):
+    """Returns file_name if there's OSM data for it, else None. Overpass JSON of older versions is converted first"""
+    if not os.path.exists(file_name) and os.path.exists(json_name(file_name)):
+        try:
+            convert_osm(json_name(file_name), file_name)
+            log.info(f"Converted {json_name(file_name)} to {file_name}")
+        except (ValueError, KeyError):
+            log.error(f"Couldn't read {json_name(file_name)}. Getting new OSM data instead")
+    return file_name if os.path.exists(file_name) else None
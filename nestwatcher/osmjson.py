@@ -0,0 +1,142 @@
+import codecs
+import json
+import re
+
+# Incremental parser for Overpass' JSON output, so a response or file never has to be in memory as a whole
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+DELIMITERS = " \t\n\r,:]}"
+_decoder = json.JSONDecoder()
+_incomplete = object()
+
+class ElementStream():
+    """
+    Feed it Overpass' JSON in chunks of bytes. Every element of "elements" goes to on_element as soon as it's
+    complete, the other top level keys (version, osm3s, remark, ...) end up in meta.
+    Only one element at a time is a dict, so memory only grows with what on_element keeps.
+    """
+    def __init__(self, on_element):
+        self.on_element = on_element
+        self.meta = {}
+        # Start of the text, for error messages when it isn't JSON (e.g. Overpass' HTML error pages)
+        self.head = ""
+        self._text = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._buffer = ""
+        self._pos = 0
+        self._state = "start"
+        self._key = None
+
+    def feed(self, data, final=False):
+        text = self._text.decode(data, final)
+        if len(self.head) < 1000:
+            self.head += text[:1000 - len(self.head)]
+        self._buffer = self._buffer[self._pos:] + text
+        self._pos = 0
+        self._parse(final)
+
+    def close(self):
+        self.feed(b"", final=True)
+        if self._state != "end":
+            raise ValueError("Overpass' JSON ended early")
+
+    def _skip(self):
+        self._pos = WHITESPACE.match(self._buffer, self._pos).end()
+        return self._buffer[self._pos] if self._pos < len(self._buffer) else None
+
+    def _decode(self, final):
+        try:
+            value, end = _decoder.raw_decode(self._buffer, self._pos)
+        except json.JSONDecodeError:
+            if final:
+                raise ValueError(f"Invalid JSON at {self._buffer[self._pos:self._pos + 100]!r}")
+            return _incomplete
+        # A number at the end of a chunk could go on in the next one ("0." decodes as 0)
+        if not final and (end == len(self._buffer) or self._buffer[end] not in DELIMITERS):
+            return _incomplete
+        self._pos = end
+        return value
+
+    def _expect(self, char, expected):
+        if char != expected:
+            raise ValueError(f"Expected {expected!r} in Overpass' JSON, got {char!r}")
+        self._pos += 1
+
+    def _parse(self, final):
+        while True:
+            char = self._skip()
+            if char is None:
+                return
+            if self._state == "start":
+                self._expect(char, "{")
+                self._state = "key"
+            elif self._state == "key":
+                if char == "}":
+                    self._pos += 1
+                    self._state = "end"
+                elif char == ",":
+                    self._pos += 1
+                else:
+                    key = self._decode(final)
+                    if key is _incomplete:
+                        return
+                    self._key = key
+                    self._state = "colon"
+            elif self._state == "colon":
+                self._expect(char, ":")
+                self._state = "elements start" if self._key == "elements" else "value"
+            elif self._state == "value":
+                value = self._decode(final)
+                if value is _incomplete:
+                    return
+                self.meta[self._key] = value
+                self._state = "key"
+            elif self._state == "elements start":
+                self._expect(char, "[")
+                self._state = "elements"
+            elif self._state == "elements":
+                self._elements(final)
+                if self._state == "elements":
+                    return
+            else:
+                raise ValueError(f"Unexpected {char!r} after the end of Overpass' JSON")
+
+    def _elements(self, final):
+        # Nearly all of a response is elements, so this is _parse's loop for them with less overhead per element
+        buffer = self._buffer
+        length = len(buffer)
+        pos = self._pos
+        skip = WHITESPACE.match
+        scan = _decoder.scan_once
+        on_element = self.on_element
+        while True:
+            pos = skip(buffer, pos).end()
+            if pos >= length:
+                break
+            char = buffer[pos]
+            if char == ",":
+                pos += 1
+                continue
+            if char == "]":
+                pos += 1
+                self._state = "key"
+                break
+            try:
+                element, end = scan(buffer, pos)
+            except (StopIteration, json.JSONDecodeError):
+                if final:
+                    raise ValueError(f"Invalid JSON at {buffer[pos:pos + 100]!r}")
+                break
+            if not final and (end == length or buffer[end] not in DELIMITERS):
+                break
+            pos = end
+            on_element(element)
+        self._pos = pos
+
+def stream_file(file_name, on_element, block_size=1 << 20):
+    """Streams the elements of an Overpass JSON file to on_element. Returns the other top level keys"""
+    stream = ElementStream(on_element)
+    with open(file_name, mode="rb") as json_file:
+        for block in iter(lambda: json_file.read(block_size), b""):
+            stream.feed(block)
+    stream.close()
+    return stream.meta
@@ -1,102 +1,239 @@
-import requests
+import asyncio
+import aiohttp
+import os
+import re
 import time
-import json
 import timeit
 
 from nestwatcher.logging import log
+from nestwatcher.osmfile import OSMBuilder, convert_osm, write_osm
+from nestwatcher.osmjson import ElementStream
 
-def fetch_data(bbox, date):
-    data = """
-    [out:json]
-    [date:"{date}"]
-    [timeout:100000]
-    [bbox:{bbox}];
-    (
-        way[leisure=park];
-        way[landuse=recreation_ground];
-        way[leisure=recreation_ground];
-        way[leisure=pitch];
-        way[leisure=garden];
-        way[leisure=golf_course];
-        way[leisure=playground];
-        way[landuse=meadow];
-        way[landuse=grass];
-        way[landuse=greenfield];
-        way[natural=scrub];
-        way[natural=heath];
-        way[natural=grassland];
-        way[landuse=farmyard];
-        way[landuse=vineyard];
-        way[landuse=farmland];
-        way[landuse=orchard];
-        way[natural=plateau];
-        way[natural=moor];
-        way["leisure"="nature_reserve"];
-        
-        rel[leisure=park];
-        rel[landuse=recreation_ground];
-        rel[leisure=recreation_ground];
-        rel[leisure=pitch];
-        rel[leisure=garden];
-        rel[leisure=golf_course];
-        rel[leisure=playground];
-        rel[landuse=meadow];
-        rel[landuse=grass];
-        rel[landuse=greenfield];
-        rel[natural=scrub];
-        rel[natural=heath];
-        rel[natural=grassland];
-        rel[landuse=farmyard];
-        rel[landuse=vineyard];
-        rel[landuse=farmland];
-        rel[landuse=orchard];
-        rel[natural=plateau];
-        rel[natural=moor];
-        rel["leisure"="nature_reserve"];
-    );
-    out body;
-    >;
-    out skel qt;
+# Waits after a failed request double from RETRY_WAIT up to MAX_RETRY_WAIT
+RETRY_WAIT = 60
+MAX_RETRY_WAIT = 30 * 60
+# Wait when the status page can't be read or has no time for the next slot
+STATUS_WAIT = 60
+# Added to the status page's time for the next slot
+SLOT_MARGIN = 15
 
+QUERY = """
+[out:json]
+[date:"{date}"]
+[timeout:100000]
+[bbox:{bbox}];
+(
+    way[leisure=park];
+    way[landuse=recreation_ground];
+    way[leisure=recreation_ground];
+    way[leisure=pitch];
+    way[leisure=garden];
+    way[leisure=golf_course];
+    way[leisure=playground];
+    way[landuse=meadow];
+    way[landuse=grass];
+    way[landuse=greenfield];
+    way[natural=scrub];
+    way[natural=heath];
+    way[natural=grassland];
+    way[landuse=farmyard];
+    way[landuse=vineyard];
+    way[landuse=farmland];
+    way[landuse=orchard];
+    way[natural=plateau];
+    way[natural=moor];
+    way["leisure"="nature_reserve"];
+    
+    rel[leisure=park];
+    rel[landuse=recreation_ground];
+    rel[leisure=recreation_ground];
+    rel[leisure=pitch];
+    rel[leisure=garden];
+    rel[leisure=golf_course];
+    rel[leisure=playground];
+    rel[landuse=meadow];
+    rel[landuse=grass];
+    rel[landuse=greenfield];
+    rel[natural=scrub];
+    rel[natural=heath];
+    rel[natural=grassland];
+    rel[landuse=farmyard];
+    rel[landuse=vineyard];
+    rel[landuse=farmland];
+    rel[landuse=orchard];
+    rel[natural=plateau];
+    rel[natural=moor];
+    rel["leisure"="nature_reserve"];
+);
+out body;
+>;
+out skel qt;
+
+"""
+
+class SlotScheduler():
+    """
+    Keeps track of the Overpass slots of this IP. Queries only go out while the status page has free slots,
+    otherwise it waits until the time the status page gives for the next one.
     """
+    def __init__(self, session, status_url):
+        self.session = session
+        self.status_url = status_url
+        self.limit = None
+        self.free = 0
+        self.running = 0
+        # Without a status page (e.g. an own Overpass instance) there's nothing to wait for
+        self.unlimited = not status_url
+        self.lock = asyncio.Lock()
+        self.released = asyncio.Event()
 
-    data = data.format(bbox=bbox, date=date)
+    async def status(self):
+        """Returns (rate limit, free slots, seconds until the next slot or None) from the status page"""
+        async with self.session.get(self.status_url) as r:
+            text = await r.text()
+        limit = re.search(r"Rate limit: (\d+)", text)
+        free = re.search(r"(\d+) slots? available now", text)
+        waits = [int(seconds) for seconds in re.findall(r"in (-?\d+) seconds", text)]
+        return (
+            int(limit.group(1)) if limit is not None else None,
+            int(free.group(1)) if free is not None else 0,
+            min(waits) if waits else None
+        )
 
-    r = requests.post("https://overpass.kumi.systems/api/interpreter", data=data)
-    try:
-        return r.json()
-    except:
-        return {"remark": r.content}
-
-def get_osm_data(bbox, date, osm_file_name):
-    got_data = False
-    while not got_data:
-        free_slot = False
-        while not free_slot:
-            r = requests.get("http://overpass-api.de/api/status").text
-            if "available now" in r:
-                free_slot = True
-            else:
-                if "Slot available after" in r:
-                    rate_seconds = int(r.split(", in ")[1].split(" seconds.")[0]) + 15
-                    log.warning(f"Overpass is rate-limiting you. Gonna have to wait {rate_seconds} seconds before continuing")
-                    time.sleep(rate_seconds)
+    async def wait_for_release(self):
+        self.released.clear()
+        try:
+            await asyncio.wait_for(self.released.wait(), STATUS_WAIT)
+        except asyncio.TimeoutError:
+            pass
+
+    async def acquire(self):
+        if self.unlimited:
+            return
+        async with self.lock:
+            while True:
+                # Queries that were just sent might not be on the status page yet, so never more than the limit go out
+                if self.limit and self.running >= self.limit:
+                    await self.wait_for_release()
+                    continue
+                # Slots are only counted down locally until they're used up, then the status page is asked again
+                if self.free > 0:
+                    break
+                try:
+                    self.limit, self.free, wait = await self.status()
+                except aiohttp.ClientError:
+                    log.warning(f"Had trouble finding out about your overpass status. Waiting {STATUS_WAIT} seconds before trying again")
+                    await asyncio.sleep(STATUS_WAIT)
+                    continue
+                if self.limit == 0:
+                    self.unlimited = True
+                    return
+                if self.free > 0:
+                    break
+                if wait is not None:
+                    wait = max(wait, 0) + SLOT_MARGIN
+                    log.warning(f"Overpass is rate-limiting you. Gonna have to wait {wait} seconds before continuing")
+                    await asyncio.sleep(wait)
                 else:
-                    log.warning("Had trouble finding out about your overpass status. Waiting 1 minute before trying again")
-                    time.sleep(60)
+                    # All slots are taken by running queries. Their slots free up some time after they're done
+                    await self.wait_for_release()
+            self.free -= 1
+            self.running += 1
+
+    def release(self):
+        if self.unlimited:
+            return
+        self.running -= 1
+        self.released.set()
+
+async def fetch_data(session, url, bbox, date):
+    """
+    Returns (OSMData or None, Overpass' remark). Elements are parsed into the OSMData while the response
+    is still downloading, so it never has to be in memory as JSON.
+    """
+    builder = OSMBuilder()
+    stream = ElementStream(builder.add)
+    try:
+        async with session.post(url, data=QUERY.format(bbox=bbox, date=date)) as r:
+            async for chunk in r.content.iter_chunked(1 << 16):
+                stream.feed(chunk)
+        stream.close()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        return None, str(e)
+    except ValueError:
+        # Not JSON, e.g. an error page
+        return None, stream.head
+    return builder.build(), stream.meta.get("remark")
 
-        log.info("Getting OSM data. This will take ages if this is your first run.")
+async def fetch_area(session, scheduler, url, name, bbox, date, file_name):
+    attempt = 0
+    while True:
+        await scheduler.acquire()
+        log.info(f"Getting OSM data for {name}. This will take ages if this is your first run.")
         osm_time_start = timeit.default_timer()
-        nest_json = fetch_data(bbox, date)
-        osm_time_stop = timeit.default_timer()
-        seconds = round(osm_time_stop - osm_time_start, 1)
-        if len(nest_json.get("elements", [])) == 0:
-            log.error(f"Overpass did not return any data in {seconds} seconds. This could have different causes. Check if your geofence doesn't have its lat/lon switched up. Sleeping 5 minutes and trying again.\nIf you want, you can share the below log entry in Discord")
-            log.error(nest_json.get("remark"))
-            time.sleep(60*5)
-        else:
-            got_data = True
-            with open(osm_file_name, mode='w', encoding="utf-8") as osm_file:
-                osm_file.write(json.dumps(nest_json, indent=4))
-            log.success(f"Done. Got all OSM data in {seconds} seconds and saved it.")
-    return nest_json
+        osm, remark = await fetch_data(session, url, bbox, date)
+        scheduler.release()
+        seconds = round(timeit.default_timer() - osm_time_start, 1)
+        # A complete reply without a remark is fine even if it's empty, e.g. a tile that's only sea.
+        # Errors, remarks (like timeouts) and anything that isn't JSON are tried again
+        if osm is not None and not remark:
+            break
+        wait = min(MAX_RETRY_WAIT, RETRY_WAIT * 2 ** attempt)
+        attempt += 1
+        log.error(f"Overpass did not return any data for {name} in {seconds} seconds. This could have different causes. Check if your geofence doesn't have its lat/lon switched up. Trying again in {wait} seconds.\nIf you want, you can share the below log entry in Discord")
+        log.error(remark)
+        await asyncio.sleep(wait)
+
+    if osm.empty:
+        log.warning(f"There are no parks in {name}. If that's not right, check if your geofence doesn't have its lat/lon switched up")
+    # Writing a big file shouldn't hold up the other areas' downloads
+    await asyncio.get_running_loop().run_in_executor(None, write_osm, file_name, osm)
+    log.success(f"Done. Got all OSM data for {name} in {seconds} seconds and saved it.")
+    return file_name
+
+def read_fixtures(fixtures, areas):
+    """Offline mode: OSM data comes from {fixtures}/{area name}.json instead of Overpass"""
+    results = {}
+    for name, bbox, file_name in areas:
+        try:
+            convert_osm(os.path.join(fixtures, f"{name}.json"), file_name)
+        except FileNotFoundError:
+            log.error(f"No OSM fixture for {name} in {fixtures}")
+            continue
+        except ValueError as e:
+            log.error(f"Couldn't read the OSM fixture for {name}: {e}")
+            continue
+        results[name] = file_name
+    return results
+
+async def fetch_areas(config, areas, date):
+    """
+    areas are (name, bbox, file name). They're queued and fetched config.overpass_concurrency at a time,
+    each as soon as Overpass has a free slot. Returns {name: file name} of the ones that were saved
+    """
+    if config.overpass_fixtures:
+        return read_fixtures(config.overpass_fixtures, areas)
+
+    results = {}
+    queue = asyncio.Queue()
+    for area in areas:
+        queue.put_nowait(area)
+
+    # Overpass queries can take a long time, so there's no overall timeout
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None)) as session:
+        scheduler = SlotScheduler(session, config.overpass_status_url)
+
+        async def worker():
+            while not queue.empty():
+                name, bbox, file_name = queue.get_nowait()
+                results[name] = await fetch_area(session, scheduler, config.overpass_url, name, bbox, date, file_name)
+
+        await asyncio.gather(*[worker() for _ in range(max(1, min(config.overpass_concurrency, len(areas))))])
+    return results
+
+def get_osm_data(config, areas, date):
+    start = time.time()
+    results = asyncio.run(fetch_areas(config, areas, date))
+    if len(areas) > 1:
+        log.info(f"Got {len(results)} of {len(areas)} OSM files in {round(time.time() - start, 1)} seconds")
+    return results
@@ -0,0 +1,77 @@
+import math
+import multiprocessing
+import shapely
+
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from shapely.errors import TopologicalError
+
+from nestwatcher.area import get_center
+
+# More chunks than workers, so one slow chunk (e.g. a huge relation) doesn't hold up everything else
+CHUNKS_PER_WORKER = 4
+
+def _chunks(items, count):
+    size = max(1, math.ceil(len(items) / count))
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+class ParkPool():
+    """
+    Worker processes shared by in_geofence and park_centers of one park build.
+    Workers are forked, so where there's no fork() (Windows) everything runs in this process instead.
+    """
+    def __init__(self, workers):
+        self.workers = workers if "fork" in multiprocessing.get_all_start_methods() else 1
+        self._executor = None
+
+    def __enter__(self):
+        if self.workers > 1:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("fork"))
+        return self
+
+    def __exit__(self, *exc):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    @property
+    def parallel(self):
+        return self._executor is not None
+
+    def map(self, func, items, *args):
+        # Chunks are merged back in order, so results are the same as in a serial run
+        chunks = _chunks(items, self.workers * CHUNKS_PER_WORKER)
+        results = self._executor.map(func, chunks, *[repeat(arg) for arg in args])
+        return [result for chunk in results for result in chunk]
+
+def _contains(park_wkbs, fence_wkb):
+    fence = shapely.from_wkb(fence_wkb)
+    shapely.prepare(fence)
+    return shapely.contains(fence, shapely.from_wkb(park_wkbs)).tolist()
+
+def _get_centers(polygons):
+    centers = []
+    for polygon in polygons:
+        try:
+            centers.append(get_center(polygon))
+        except TopologicalError:
+            # generate_details will run into this again and count it
+            centers.append(None)
+    return centers
+
+def _centers(park_wkbs):
+    return _get_centers(shapely.from_wkb(park_wkbs))
+
+def in_geofence(fence, parks, pool=None):
+    """Whether each park is inside the geofence"""
+    if pool is None or not pool.parallel or len(parks) <= 1:
+        return [fence.contains(park.polygon) for park in parks]
+    park_wkbs = list(shapely.to_wkb([park.polygon for park in parks]))
+    return pool.map(_contains, park_wkbs, shapely.to_wkb(fence))
+
+def park_centers(parks, pool=None):
+    """{park: (lat, lon)} of each park's center. None for parks where that failed"""
+    if pool is None or not pool.parallel or len(parks) <= 1:
+        return dict(zip(parks, _get_centers([park.polygon for park in parks])))
+    park_wkbs = list(shapely.to_wkb([park.polygon for park in parks]))
+    return dict(zip(parks, pool.map(_centers, park_wkbs)))
@@ -0,0 +1,101 @@
+import os
+import struct
+import hashlib
+import numpy as np
+import shapely
+
+from shapely.errors import ShapelyError
+
+from nestwatcher.area import WayPark, RelPark
+from nestwatcher.binfile import append_aligned, read_binfile, write_binfile
+from nestwatcher.logging import log
+
+# A binfile with WKB and float64 [lat, lon] paths in the blob
+MAGIC = b"NWPARK01"
+
+def park_cache_name(osm_file_name):
+    return osm_file_name.rsplit(".", 1)[0] + ".parks"
+
+def park_cache_key(osm_file_names, area, area_file_data, quick=False):
+    """
+    Parks only have to be rebuilt if the OSM data, the geofence or any connect changed.
+    With quick, OSM files are compared by size and modification time instead of their content. Good enough
+    for parks kept in memory, which would otherwise hash every OSM file again on each run
+    """
+    if quick:
+        osm = []
+        for osm_file_name in osm_file_names:
+            stat = os.stat(osm_file_name)
+            osm.append([osm_file_name, stat.st_size, stat.st_mtime_ns])
+    else:
+        osm_hash = hashlib.sha1()
+        for osm_file_name in osm_file_names:
+            with open(osm_file_name, mode="rb") as osm_file:
+                for block in iter(lambda: osm_file.read(1 << 20), b""):
+                    osm_hash.update(block)
+        osm = osm_hash.hexdigest()
+    connects = {str(osm_id): data["connect"] for osm_id, data in sorted(area_file_data.items()) if data.get("connect")}
+    return {
+        "osm": osm,
+        "fence": area.sql_fence,
+        "connect": connects
+    }
+
+def write_park_cache(file_name, key, parks, centers, failed):
+    blob = bytearray()
+    records = []
+    for park in parks:
+        wkb = shapely.to_wkb(park.polygon)
+        paths = []
+        for path in park.path:
+            paths.append([append_aligned(blob, np.asarray(path, dtype="<f8").tobytes()), len(path)])
+        records.append({
+            "id": park.id,
+            "type": "relation" if isinstance(park, RelPark) else "way",
+            "tags": park._element.get("tags", {}),
+            "connect": park.connect,
+            "center": centers.get(park),
+            "wkb": [append_aligned(blob, wkb), len(wkb)],
+            "paths": paths
+        })
+    write_binfile(file_name, MAGIC, {"key": key, "failed": failed, "parks": records}, blob)
+
+def read_park_cache(file_name, key, config):
+    """Returns (parks, centers, failed counts) or None if there's no usable cache for this key"""
+    try:
+        return _read_park_cache(file_name, key, config)
+    except FileNotFoundError:
+        return None
+    except (ValueError, KeyError, struct.error, ShapelyError) as e:
+        # Parks are just built again and the cache overwritten
+        log.warning(f"Park cache {file_name} is broken ({e}). Ignoring it")
+        return None
+
+def _read_park_cache(file_name, key, config):
+    header, data, blob_start = read_binfile(file_name, MAGIC)
+    if header["key"] != key:
+        return None
+
+    parks = []
+    centers = {}
+    for record in header["parks"]:
+        park_class = RelPark if record["type"] == "relation" else WayPark
+        park = park_class({"type": record["type"], "id": record["id"], "tags": record["tags"]}, config)
+
+        offset, length = record["wkb"]
+        wkb = data[blob_start + offset:blob_start + offset + length]
+        if len(wkb) != length:
+            raise ValueError("it's cut off")
+        polygon = shapely.from_wkb(wkb)
+        paths = []
+        for offset, length in record["paths"]:
+            coords = np.frombuffer(data, dtype="<f8", count=length * 2, offset=blob_start + offset)
+            paths.append(coords.reshape(length, 2).tolist())
+        park.set_geometry(polygon, paths)
+        park.connect = record["connect"]
+
+        if record["center"] is not None:
+            centers[park] = tuple(record["center"])
+        parks.append(park)
+
+    return parks, centers, header["failed"]
@@ -0,0 +1,26 @@
+import cProfile
+import os
+
+from datetime import datetime
+
+from nestwatcher.logging import log
+
+def profile_file_name(name):
+    return f"data/profiles/{name} {datetime.now().strftime('%Y-%m-%d %H%M%S')}.prof"
+
+def profiled(enabled, name, func, *args, **kwargs):
+    """
+    Runs func, with cProfile if enabled, and writes the stats to data/profiles/.
+    Open them with e.g. snakeviz or turn them into a flamegraph with flameprof.
+    """
+    if not enabled:
+        return func(*args, **kwargs)
+
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        file_name = profile_file_name(name)
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        profiler.dump_stats(file_name)
+        log.info(f"Saved profile to {file_name}")
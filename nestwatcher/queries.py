@@ -1,19 +1,35 @@
+import queue
+import timeit
 import pymysql
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta 
 
+from nestwatcher.stats import RunStats
+
+# Rows per INSERT into the temporary park member tables of park_mons
+MEMBER_BATCH_SIZE = 1000
+
 class Queries():
     def __init__(self, config):
         self.config = config
-        self.connection = pymysql.connect(
-            host=config.db_host,
-            user=config.db_user,
-            password=config.db_password,
-            database=config.db_name,
-            port=config.db_port,
-            autocommit=True
-        )
-        self.cursor = self.connection.cursor()
+        # Every connection is only used by one thread at a time. Queries that don't depend on each other
+        # can run on different connections, so their round trips to the DB overlap
+        self.pool_size = max(1, config.db_pool_size)
+        self.pool = queue.Queue()
+        self.connections = []
+        for _ in range(self.pool_size):
+            connection = pymysql.connect(
+                host=config.db_host,
+                user=config.db_user,
+                password=config.db_password,
+                database=config.db_name,
+                port=config.db_port,
+                autocommit=True
+            )
+            self.connections.append(connection)
+            self.pool.put(connection)
 
         self.nest_connection = pymysql.connect(
             host=config.nest_db_host,
@@ -28,88 +44,188 @@ class Queries():
         if config.scanner == "rdm":
             pokestop_select = """SELECT id, lat, lon
             FROM pokestop
-            WHERE ST_CONTAINS(ST_GEOMFROMTEXT('MULTIPOLYGON(({area}))'), point(lat, lon))"""
+            WHERE ST_CONTAINS(ST_GEOMFROMTEXT(%(area)s), point(lat, lon))"""
             spawnpoint_select = """SELECT id, lat, lon
             FROM spawnpoint
-            WHERE ST_CONTAINS(ST_GEOMFROMTEXT('MULTIPOLYGON(({area}))'), point(lat, lon))
+            WHERE ST_CONTAINS(ST_GEOMFROMTEXT(%(area)s), point(lat, lon))
             """
             mon_select = """SELECT pokemon_id, COUNT(pokemon_id) AS count
             FROM {pokemon}
             WHERE (
                 (
-                    pokestop_id IN ({pokestops})
+                    pokestop_id IN %(pokestops)s
                     OR
-                    spawn_id IN ({spawnpoints})
+                    spawn_id IN %(spawnpoints)s
                 )
                 AND
-                pokemon_id IN {nest_mons}
+                pokemon_id IN %(nest_mons)s
                 AND
-                first_seen_timestamp >= {reset_time})
+                first_seen_timestamp >= %(reset_time)s)
             GROUP BY pokemon_id
             ORDER BY count desc
             LIMIT 1"""
             most_mon = """SELECT pokemon_id, COUNT(pokemon_id) AS count
             FROM {pokemon}
             WHERE (
-                pokemon_id IN {nest_mons}
+                pokemon_id IN %(nest_mons)s
                 AND
-                first_seen_timestamp >= {reset_time})
+                first_seen_timestamp >= %(reset_time)s)
             GROUP BY pokemon_id
             ORDER BY count desc
             LIMIT 1"""
             all_mons = """SELECT pokemon_id, lat, lon
             FROM {pokemon}
             WHERE (
-                pokemon_id IN {nest_mons}
+                pokemon_id IN %(nest_mons)s
+                AND
+                ST_CONTAINS(ST_GEOMFROMTEXT(%(area)s), point(lat, lon))
+                AND
+                first_seen_timestamp >= %(reset_time)s
+            )
+            """
+            park_members = [
+                "DROP TEMPORARY TABLE IF EXISTS nest_park_spawns, nest_park_stops",
+                "CREATE TEMPORARY TABLE nest_park_spawns (park_id INT NOT NULL, spawn_id BIGINT UNSIGNED NOT NULL, KEY (spawn_id))",
+                "CREATE TEMPORARY TABLE nest_park_stops (park_id INT NOT NULL, pokestop_id VARCHAR(35) NOT NULL, KEY (pokestop_id))"
+            ]
+            # UNION (not UNION ALL) so a sighting with its spawnpoint and pokestop in the same park counts once
+            park_mons = """SELECT park_id, pokemon_id, count
+            FROM (
+                SELECT park_id, pokemon_id, COUNT(*) AS count,
+                    ROW_NUMBER() OVER (PARTITION BY park_id ORDER BY COUNT(*) DESC, pokemon_id) AS place
+                FROM (
+                    SELECT members.park_id, mon.id, mon.pokemon_id
+                    FROM {pokemon} AS mon
+                    JOIN nest_park_spawns AS members ON members.spawn_id = mon.spawn_id
+                    WHERE mon.pokemon_id IN %(nest_mons)s AND mon.first_seen_timestamp >= %(reset_time)s
+                    UNION
+                    SELECT members.park_id, mon.id, mon.pokemon_id
+                    FROM {pokemon} AS mon
+                    JOIN nest_park_stops AS members ON members.pokestop_id = mon.pokestop_id
+                    WHERE mon.pokemon_id IN %(nest_mons)s AND mon.first_seen_timestamp >= %(reset_time)s
+                ) AS park_sightings
+                GROUP BY park_id, pokemon_id
+            ) AS ranked
+            WHERE place = 1
+            """
+            bbox_pokestops = """SELECT id, lat, lon
+            FROM pokestop
+            WHERE lat BETWEEN %(min_lat)s AND %(max_lat)s AND lon BETWEEN %(min_lon)s AND %(max_lon)s"""
+            bbox_spawns = """SELECT id, lat, lon
+            FROM spawnpoint
+            WHERE lat BETWEEN %(min_lat)s AND %(max_lat)s AND lon BETWEEN %(min_lon)s AND %(max_lon)s"""
+            # settled: whether a sighting is older than settle_time, see analyze_nests
+            bbox_mons = """SELECT pokemon_id, spawn_id, pokestop_id, first_seen_timestamp < %(settle_time)s AS settled
+            FROM {pokemon}
+            WHERE (
+                pokemon_id IN %(nest_mons)s
+                AND
+                lat BETWEEN %(min_lat)s AND %(max_lat)s AND lon BETWEEN %(min_lon)s AND %(max_lon)s
+                AND
+                first_seen_timestamp >= %(reset_time)s
+            )
+            """
+            # Same sightings as bbox_mons, already summed up per spawnpoint/pokestop and mon
+            bbox_mon_counts = """SELECT pokemon_id, spawn_id, pokestop_id, first_seen_timestamp < %(settle_time)s AS settled,
+                COUNT(*) AS count
+            FROM {pokemon}
+            WHERE (
+                pokemon_id IN %(nest_mons)s
                 AND
-                ST_CONTAINS(ST_GEOMFROMTEXT('POLYGON({area})'), point(lat, lon))
+                lat BETWEEN %(min_lat)s AND %(max_lat)s AND lon BETWEEN %(min_lon)s AND %(max_lon)s
                 AND
-                first_seen_timestamp >= {reset_time}
+                first_seen_timestamp >= %(reset_time)s
             )
+            GROUP BY pokemon_id, spawn_id, pokestop_id, settled
             """
 
         elif config.scanner == "mad":
             pokestop_select = """SELECT pokestop_id, latitude, longitude
             FROM pokestop
-            WHERE ST_CONTAINS(ST_GEOMFROMTEXT('MULTIPOLYGON(({area}))'), point(latitude, longitude))"""
+            WHERE ST_CONTAINS(ST_GEOMFROMTEXT(%(area)s), point(latitude, longitude))"""
             spawnpoint_select = """SELECT spawnpoint, latitude, longitude
             FROM trs_spawn
-            WHERE ST_CONTAINS(ST_GEOMFROMTEXT('MULTIPOLYGON(({area}))'), point(latitude, longitude))
+            WHERE ST_CONTAINS(ST_GEOMFROMTEXT(%(area)s), point(latitude, longitude))
             """
             mon_select = """SELECT pokemon_id, COUNT(pokemon_id) AS count
             FROM {pokemon}
             WHERE (
                 (
-                    spawnpoint_id IN ({spawnpoints})
+                    spawnpoint_id IN %(spawnpoints)s
                 )
                 AND
-                pokemon_id IN {nest_mons}
+                pokemon_id IN %(nest_mons)s
                 AND
-                UNIX_TIMESTAMP(last_modified) >= {reset_time})
+                UNIX_TIMESTAMP(last_modified) >= %(reset_time)s)
             GROUP BY pokemon_id
             ORDER BY count desc
             LIMIT 1"""
             most_mon = """SELECT pokemon_id, COUNT(pokemon_id) AS count
             FROM {pokemon}
             WHERE (
-                pokemon_id IN {nest_mons}
+                pokemon_id IN %(nest_mons)s
                 AND
-                UNIX_TIMESTAMP(last_modified) >= {reset_time})
+                UNIX_TIMESTAMP(last_modified) >= %(reset_time)s)
             GROUP BY pokemon_id
             ORDER BY count desc
             LIMIT 1"""
             all_mons = """SELECT pokemon_id, latitude, longitude
             FROM {pokemon}
             WHERE (
-                pokemon_id IN {nest_mons}
+                pokemon_id IN %(nest_mons)s
+                AND
+                ST_CONTAINS(ST_GEOMFROMTEXT(%(area)s), point(latitude, longitude))
+                AND
+                UNIX_TIMESTAMP(last_modified) >= %(reset_time)s
+            )
+            """
+            park_members = [
+                "DROP TEMPORARY TABLE IF EXISTS nest_park_spawns, nest_park_stops",
+                "CREATE TEMPORARY TABLE nest_park_spawns (park_id INT NOT NULL, spawn_id BIGINT UNSIGNED NOT NULL, KEY (spawn_id))",
+                "CREATE TEMPORARY TABLE nest_park_stops (park_id INT NOT NULL, pokestop_id VARCHAR(50) NOT NULL, KEY (pokestop_id))"
+            ]
+            # MAD doesn't link mons to pokestops, so nest_park_stops stays unused
+            park_mons = """SELECT park_id, pokemon_id, count
+            FROM (
+                SELECT members.park_id, mon.pokemon_id, COUNT(*) AS count,
+                    ROW_NUMBER() OVER (PARTITION BY members.park_id ORDER BY COUNT(*) DESC, mon.pokemon_id) AS place
+                FROM {pokemon} AS mon
+                JOIN nest_park_spawns AS members ON members.spawn_id = mon.spawnpoint_id
+                WHERE mon.pokemon_id IN %(nest_mons)s AND UNIX_TIMESTAMP(mon.last_modified) >= %(reset_time)s
+                GROUP BY members.park_id, mon.pokemon_id
+            ) AS ranked
+            WHERE place = 1
+            """
+            bbox_pokestops = """SELECT pokestop_id, latitude, longitude
+            FROM pokestop
+            WHERE latitude BETWEEN %(min_lat)s AND %(max_lat)s AND longitude BETWEEN %(min_lon)s AND %(max_lon)s"""
+            bbox_spawns = """SELECT spawnpoint, latitude, longitude
+            FROM trs_spawn
+            WHERE latitude BETWEEN %(min_lat)s AND %(max_lat)s AND longitude BETWEEN %(min_lon)s AND %(max_lon)s"""
+            bbox_mons = """SELECT pokemon_id, spawnpoint_id, NULL, UNIX_TIMESTAMP(last_modified) < %(settle_time)s AS settled
+            FROM {pokemon}
+            WHERE (
+                pokemon_id IN %(nest_mons)s
+                AND
+                latitude BETWEEN %(min_lat)s AND %(max_lat)s AND longitude BETWEEN %(min_lon)s AND %(max_lon)s
+                AND
+                UNIX_TIMESTAMP(last_modified) >= %(reset_time)s
+            )
+            """
+            bbox_mon_counts = """SELECT pokemon_id, spawnpoint_id, NULL, UNIX_TIMESTAMP(last_modified) < %(settle_time)s AS settled,
+                COUNT(*) AS count
+            FROM {pokemon}
+            WHERE (
+                pokemon_id IN %(nest_mons)s
                 AND
-                ST_CONTAINS(ST_GEOMFROMTEXT('POLYGON({area})'), point(latitude, longitude))
+                latitude BETWEEN %(min_lat)s AND %(max_lat)s AND longitude BETWEEN %(min_lon)s AND %(max_lon)s
                 AND
-                UNIX_TIMESTAMP(last_modified) >= {reset_time}
+                UNIX_TIMESTAMP(last_modified) >= %(reset_time)s
             )
+            GROUP BY pokemon_id, spawnpoint_id, settled
             """
 
-        nest_delete = "DELETE FROM nests where ST_CONTAINS(ST_GEOMFROMTEXT('POLYGON({area})'), point(lat, lon)) and updated < {reset_time}"
+        nest_delete = "DELETE FROM nests where ST_CONTAINS(ST_GEOMFROMTEXT(%(area)s), point(lat, lon)) and updated < %(reset_time)s"
         nest_insert = """INSERT INTO nests (
             nest_id, name, lat, lon, pokemon_id, pokemon_form, type, pokemon_count, pokemon_avg, updated,
             pokemon_ratio, polygon_type, polygon_path)
@@ -118,18 +234,18 @@ class Queries():
             %(pokemon_id)s, %(form)s, %(type)s, %(pokemon_count)s, %(pokemon_avg)s, %(current_time)s,
             %(pokemon_ratio)s, %(poly_type)s, %(poly_path)s)
         ON DUPLICATE KEY UPDATE
-            pokemon_id = %(pokemon_id)s,
-            pokemon_form = %(form)s,
-            name = %(name)s,
-            lat = %(lat)s,
-            lon = %(lon)s,
-            type = %(type)s,
-            pokemon_count = %(pokemon_count)s,
-            pokemon_avg = %(pokemon_avg)s,
-            updated = %(current_time)s,
-            pokemon_ratio = %(pokemon_ratio)s,
-            polygon_type = %(poly_type)s,
-            polygon_path = %(poly_path)s
+            pokemon_id = VALUES(pokemon_id),
+            pokemon_form = VALUES(pokemon_form),
+            name = VALUES(name),
+            lat = VALUES(lat),
+            lon = VALUES(lon),
+            type = VALUES(type),
+            pokemon_count = VALUES(pokemon_count),
+            pokemon_avg = VALUES(pokemon_avg),
+            updated = VALUES(updated),
+            pokemon_ratio = VALUES(pokemon_ratio),
+            polygon_type = VALUES(polygon_type),
+            polygon_path = VALUES(polygon_path)
         """
 
         self.queries = {
@@ -139,45 +255,207 @@ class Queries():
             "nest_delete": nest_delete,
             "nest_insert": nest_insert,
             "most_mon": most_mon,
-            "all_mons": all_mons
+            "all_mons": all_mons,
+            "bbox_pokestops": bbox_pokestops,
+            "bbox_spawns": bbox_spawns,
+            "bbox_mons": bbox_mons,
+            "bbox_mon_counts": bbox_mon_counts,
+            "park_members": park_members,
+            "park_mons": park_mons,
+            "db_time": "SELECT UNIX_TIMESTAMP()",
+            "park_spawns_insert": "INSERT INTO nest_park_spawns (park_id, spawn_id) VALUES (%s, %s)",
+            "park_stops_insert": "INSERT INTO nest_park_stops (park_id, pokestop_id) VALUES (%s, %s)"
+        }
+        # The pokemon table is the only thing that can't be a parameter. Everything else is bound by pymysql
+        for name, query in self.queries.items():
+            if isinstance(query, str):
+                self.queries[name] = query.format(pokemon=config.custom_pokemon)
+
+        self.run_args = {}
+        # analyze_nests gives every area its own
+        self.stats = RunStats()
+
+    def set_run(self, nest_mons, reset_time):
+        # Species and migration time are the same for every query of a run, so they're only converted once
+        self.run_args = {
+            "nest_mons": tuple(int(m) for m in nest_mons) or (None,),
+            "reset_time": reset_time
         }
 
+    def _fence(self, area, multi=False):
+        if multi:
+            return {"area": f"MULTIPOLYGON(({area}))"}
+        return {"area": f"POLYGON({area})"}
+
+    def _bounds(self, bounds):
+        min_lon, min_lat, max_lon, max_lat = bounds
+        return {"min_lat": min_lat, "max_lat": max_lat, "min_lon": min_lon, "max_lon": max_lon}
+
+    def _ids(self, ids):
+        # An empty IN () isn't valid SQL
+        return tuple(ids) or (None,)
+
+    @contextmanager
+    def _scanner(self, cursor_class=None):
+        # Waits for a free connection and gives a cursor on it
+        connection = self.pool.get()
+        try:
+            with connection.cursor(cursor_class) as cursor:
+                yield cursor
+        finally:
+            self.pool.put(connection)
+
+    def _fetchall(self, name, args=None):
+        start = timeit.default_timer()
+        with self._scanner() as cursor:
+            cursor.execute(self.queries[name], args)
+            rows = cursor.fetchall()
+        self.stats.query(name, timeit.default_timer() - start, len(rows))
+        return rows
+
+    def _fetchone(self, name, args=None):
+        start = timeit.default_timer()
+        with self._scanner() as cursor:
+            cursor.execute(self.queries[name], args)
+            row = cursor.fetchone()
+        self.stats.query(name, timeit.default_timer() - start, 0 if row is None else 1)
+        return row
+
+    def _stream(self, name, args=None):
+        batches = self._stream_batches(name, args)
+        # Runs up to the query, so it's sent right away (e.g. in its gather thread) and only the rows are read later
+        next(batches)
+        return batches
+
+    def _stream_batches(self, name, args):
+        # Unbuffered cursor, so only one batch of rows is in memory at a time. The connection stays
+        # busy until every row is read or the batches are thrown away
+        with self._scanner(pymysql.cursors.SSCursor) as cursor:
+            start = timeit.default_timer()
+            cursor.execute(self.queries[name], args)
+            self.stats.query(name, timeit.default_timer() - start, 0)
+            yield None
+            while True:
+                # Only time spent waiting for the DB counts, not what's done with the batch in between
+                start = timeit.default_timer()
+                rows = cursor.fetchmany(self.config.stream_batch_size)
+                self.stats.query(name, timeit.default_timer() - start, len(rows), count=0)
+                if not rows:
+                    break
+                yield rows
+
+    def _batches(self, name, args=None):
+        """All rows of a query in a list of batches. Streamed batch by batch if stream_batch_size is set"""
+        if self.config.stream_batch_size <= 0:
+            return [self._fetchall(name, args)]
+        return self._stream(name, args)
+
+    def map(self, func, items):
+        """
+        Yields func(item) for every item, in order. Up to pool_size items are worked on at the same time,
+        so func should only use the scanner DB through this class.
+        """
+        if self.pool_size <= 1:
+            yield from map(func, items)
+            return
+        with ThreadPoolExecutor(max_workers=self.pool_size) as executor:
+            yield from executor.map(func, items)
+
+    def gather(self, *calls):
+        """Runs the given functions at the same time and returns their results"""
+        return list(self.map(lambda call: call(), calls))
+
     def stops(self, area):
-        self.cursor.execute(self.queries["pokestops"].format(area=area))
-        return self.cursor.fetchall()
+        return self._fetchall("pokestops", self._fence(area, multi=True))
 
     def spawns(self, area):
-        query = self.queries["spawns"].format(area=area)
-        #print(query + "\n\n")
-        self.cursor.execute(query)
-        return self.cursor.fetchall()
+        return self._fetchall("spawns", self._fence(area, multi=True))
     
-    def mons(self, spawns, mons, time, pokestops=None):
-        query = self.queries["mons"].format(spawnpoints=spawns, nest_mons=mons, reset_time=time, pokestops=pokestops, pokemon=self.config.custom_pokemon)
-        if not pokestops is None:
-            query = query.format(pokestops=pokestops)
-
-        self.cursor.execute(query)
-        return self.cursor.fetchone()
+    def mons(self, spawns, pokestops=None):
+        args = dict(self.run_args, spawnpoints=self._ids(spawns), pokestops=self._ids(pokestops or []))
+        return self._fetchone("mons", args)
     
-    def all_mons(self, mons, time, fence):
-        query = self.queries["all_mons"].format(nest_mons=mons, reset_time=time, area=fence, pokemon=self.config.custom_pokemon)
-        self.cursor.execute(query)
-        return self.cursor.fetchall()
+    def all_mons(self, fence):
+        return self._batches("all_mons", dict(self.run_args, **self._fence(fence)))
+
+    def bbox_stops(self, bounds):
+        return self._fetchall("bbox_pokestops", self._bounds(bounds))
+
+    def bbox_spawns(self, bounds):
+        return self._fetchall("bbox_spawns", self._bounds(bounds))
+
+    def _bbox_mons_args(self, bounds, since, settle_time):
+        args = dict(self.run_args, settle_time=settle_time, **self._bounds(bounds))
+        if since is not None:
+            # Sightings from before the migration never count
+            args["reset_time"] = max(since, self.run_args["reset_time"])
+        return args
+
+    def bbox_mons(self, bounds, since=None, settle_time=None):
+        """(pokemon_id, spawnpoint_id, pokestop_id, settled) rows. settled is whether a sighting is older than settle_time"""
+        return self._batches("bbox_mons", self._bbox_mons_args(bounds, since, settle_time))
 
-    def most_mon(self, mons, time):
-        self.cursor.execute(self.queries["most_mon"].format(nest_mons=mons, reset_time=time, pokemon=self.config.custom_pokemon))
-        return self.cursor.fetchone()
+    def bbox_mon_counts(self, bounds, since=None, settle_time=None):
+        """Same as bbox_mons, grouped by the DB with a count at the end. One row per spawnpoint, mon and settled"""
+        return self._batches("bbox_mon_counts", self._bbox_mons_args(bounds, since, settle_time))
 
-    def nest_delete(self, area, time):
-        self.nest_cursor.execute(self.queries["nest_delete"].format(area=area, reset_time=time))
+    def db_time(self):
+        """Unix time by the scanner DB's clock"""
+        return int(self._fetchone("db_time")[0])
+
+    def park_mons(self, park_spawns, park_stops):
+        """
+        park_spawns and park_stops are (park_id, id) rows. Returns (park_id, pokemon_id, count) of the
+        most seen mon of every park, all counted by the DB in one query.
+        """
+        # Temporary tables only exist on the connection that created them
+        start = timeit.default_timer()
+        with self._scanner() as cursor:
+            for query in self.queries["park_members"]:
+                cursor.execute(query)
+            for insert, rows in (("park_spawns_insert", park_spawns), ("park_stops_insert", park_stops)):
+                for i in range(0, len(rows), MEMBER_BATCH_SIZE):
+                    cursor.executemany(self.queries[insert], rows[i:i + MEMBER_BATCH_SIZE])
+
+            cursor.execute(self.queries["park_mons"], self.run_args)
+            rows = cursor.fetchall()
+        self.stats.query("park_mons", timeit.default_timer() - start, len(rows))
+        return rows
+
+    def most_mon(self):
+        return self._fetchone("most_mon", self.run_args)
+
+    def nest_delete(self, area):
+        self.nest_cursor.execute(self.queries["nest_delete"], dict(self._fence(area), reset_time=self.run_args["reset_time"]))
 
     def nest_insert(self, args):
         self.nest_cursor.execute(self.queries["nest_insert"], args)
 
+    def nest_write(self, area, nests, delete=True):
+        # One transaction per area so map readers never see it half deleted or half inserted
+        batch_size = self.config.nest_batch_size
+        start = timeit.default_timer()
+        self.nest_connection.begin()
+        try:
+            if delete:
+                self.nest_delete(area)
+            for i in range(0, len(nests), batch_size):
+                self.nest_cursor.executemany(self.queries["nest_insert"], nests[i:i + batch_size])
+            self.nest_connection.commit()
+        except Exception:
+            self.nest_connection.rollback()
+            raise
+        self.stats.query("nest_write", timeit.default_timer() - start, len(nests))
+
+    def ping(self):
+        # Connections of a long running process may have timed out on the server since the last run
+        for connection in self.connections:
+            connection.ping(reconnect=True)
+        self.nest_connection.ping(reconnect=True)
+
     def close(self):
-        self.cursor.close()
-        self.connection.close()
+        for connection in self.connections:
+            connection.close()
 
         self.nest_cursor.close()
         self.nest_connection.close()
\ No newline at end of file
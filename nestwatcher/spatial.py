@@ -0,0 +1,189 @@
+import numpy as np
+import shapely
+
+from shapely import geometry
+from shapely.ops import unary_union
+from shapely.strtree import STRtree
+
+# Points are turned into geometries this many at a time, so there's never one object per row alive
+CHUNK_SIZE = 100000
+
+def fence_polygon(park):
+    # The same shape the park's sql_fence describes (outer rings only) so results match the query path
+    return unary_union([geometry.Polygon([(lon, lat) for lat, lon in path]) for path in park.path])
+
+def boxes_outside(fence, bounds):
+    """Whether each [min lat, min lon, max lat, max lon] box doesn't touch the fence at all. Boxes with NaNs never are"""
+    if len(bounds) == 0:
+        return np.zeros(0, dtype=bool)
+    unknown = np.isnan(bounds).any(axis=1)
+    bounds = np.nan_to_num(bounds)
+    shapely.prepare(fence)
+    boxes = shapely.box(bounds[:, 1], bounds[:, 0], bounds[:, 3], bounds[:, 2])
+    return ~shapely.intersects(fence, boxes) & ~unknown
+
+def columns(rows, id_type=str):
+    """Splits (id, lat, lon) rows into an id array and float lat/lon arrays"""
+    if len(rows) == 0:
+        return np.array([], dtype=id_type), np.empty(0), np.empty(0)
+    ids, lat, lon = zip(*rows)
+    return np.array(ids, dtype=id_type), np.array(lat, dtype=float), np.array(lon, dtype=float)
+
+def lookup(table, values):
+    """Position of each value in table, -1 if it's not in there"""
+    if len(table) == 0:
+        return np.full(len(values), -1)
+    sorter = np.argsort(table)
+    pos = np.searchsorted(table, values, sorter=sorter)
+    pos[pos == len(table)] = 0
+    found = sorter[pos]
+    found[table[found] != values] = -1
+    return found
+
+def join(keys, pair_keys, pair_values):
+    """
+    For every key, all pair_values whose pair_key equals it.
+    Returns the position of the key and the value for each match.
+    """
+    order = np.argsort(pair_keys, kind="stable")
+    sorted_keys = pair_keys[order]
+    start = np.searchsorted(sorted_keys, keys, side="left")
+    lengths = np.searchsorted(sorted_keys, keys, side="right") - start
+    positions = np.repeat(np.arange(len(keys)), lengths)
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return positions, pair_values[order][np.repeat(start, lengths) + offsets]
+
+def most_common(park_idx, mon_ids, weights, park_count):
+    """
+    Sums weights per (park, mon) and returns {park_idx: (mon_id, count)} for the top mon of every park.
+    Ties go to the lower pokemon_id.
+    """
+    if len(park_idx) == 0:
+        return {}
+    mons, mon_codes = np.unique(mon_ids, return_inverse=True)
+    totals = np.bincount(park_idx * len(mons) + mon_codes, weights=weights, minlength=park_count * len(mons))
+    totals = totals.reshape(park_count, len(mons))
+    best = totals.argmax(axis=1)
+    counts = totals[np.arange(park_count), best]
+    return {int(i): (mons[best[i]].item(), int(counts[i])) for i in np.nonzero(counts)[0]}
+
+class ParkIndex():
+    """STRtree over park shapes. Points are only checked against parks whose bbox they're in"""
+    def __init__(self, parks, shapes):
+        self.parks = parks
+        self._tree = STRtree(shapes)
+
+    def assign(self, lat, lon):
+        """Returns (point_idx, park_idx) arrays for every point that's in a park"""
+        point_idx = []
+        park_idx = []
+        for start in range(0, len(lat), CHUNK_SIZE):
+            points = shapely.points(lon[start:start + CHUNK_SIZE], lat[start:start + CHUNK_SIZE])
+            chunk_points, chunk_parks = self._tree.query(points, predicate="within")
+            point_idx.append(chunk_points + start)
+            park_idx.append(chunk_parks)
+        if not point_idx:
+            return np.empty(0, dtype=int), np.empty(0, dtype=int)
+        return np.concatenate(point_idx), np.concatenate(park_idx)
+
+    def members(self, ids, point_idx, park_idx):
+        """{park: [ids of the points in it]}"""
+        order = np.argsort(park_idx, kind="stable")
+        park_ids, starts = np.unique(park_idx[order], return_index=True)
+        members = {}
+        for i, park_members in zip(park_ids, np.split(ids[point_idx[order]], starts[1:])):
+            members[self.parks[i]] = park_members.tolist()
+        return members
+
+    def top_mons(self, park_idx, mon_ids, counts=None):
+        """Top mon per park, for sightings that are already assigned to parks by location"""
+        result = most_common(park_idx, mon_ids, counts, len(self.parks))
+        return {self.parks[i]: data for i, data in result.items()}
+
+def count_mons(park_idx, mon_ids, counts=None):
+    """
+    Sums up sightings of the same mon in the same park.
+    Returns (park_idx, mon_ids, counts) arrays with one entry per park and mon.
+    """
+    park_idx = np.asarray(park_idx, dtype=int)
+    mon_ids = np.asarray(mon_ids, dtype=int)
+    if counts is None:
+        counts = np.ones(len(mon_ids), dtype=int)
+    if len(mon_ids) == 0:
+        return park_idx, mon_ids, np.asarray(counts, dtype=int)
+
+    keys, inverse = np.unique(np.stack([park_idx, mon_ids], axis=1), axis=0, return_inverse=True)
+    totals = np.bincount(inverse.ravel(), weights=counts).astype(int)
+    return keys[:, 0], keys[:, 1], totals
+
+def merge_counts(*counts):
+    return count_mons(*[np.concatenate(column) for column in zip(*counts)])
+
+def member_rows(members):
+    """(park_idx, id) rows of (ids, point_idx, park_idx) members as returned by ParkIndex.assign"""
+    ids, point_idx, park_idx = members
+    return list(zip(park_idx.tolist(), ids[point_idx].tolist()))
+
+def group_sightings(mon_ids, spawn_ids, stop_ids, counts=None):
+    """
+    Sums up sightings of the same mon on the same spawnpoint and pokestop.
+    Returns (mon_ids, spawn_ids, stop_ids, counts) arrays with one entry per group.
+    """
+    mon_ids = np.asarray(mon_ids, dtype=int)
+    spawn_ids = np.asarray(spawn_ids, dtype=str)
+    stop_ids = np.asarray(stop_ids, dtype=str)
+    if counts is None:
+        counts = np.ones(len(mon_ids), dtype=int)
+    if len(mon_ids) == 0:
+        return mon_ids, spawn_ids, stop_ids, np.asarray(counts, dtype=int)
+
+    spawn_keys, spawn_codes = np.unique(spawn_ids, return_inverse=True)
+    stop_keys, stop_codes = np.unique(stop_ids, return_inverse=True)
+    keys, inverse = np.unique(np.stack([mon_ids, spawn_codes, stop_codes], axis=1), axis=0, return_inverse=True)
+    totals = np.bincount(inverse.ravel(), weights=counts).astype(int)
+    return keys[:, 0], spawn_keys[keys[:, 1]], stop_keys[keys[:, 2]], totals
+
+def sighting_groups(sightings):
+    """
+    sightings are (pokemon_id, spawnpoint_id, pokestop_id, settled) rows, or (..., count) rows if the DB grouped
+    them already. Returns (grouped settled sightings, grouped other sightings)
+    """
+    if len(sightings) == 0:
+        return group_sightings([], [], []), group_sightings([], [], [])
+    mon_ids, spawn_ids, stop_ids, settled, *counts = zip(*sightings)
+    mon_ids = np.asarray(mon_ids, dtype=int)
+    spawn_ids = np.asarray(spawn_ids, dtype=str)
+    stop_ids = np.asarray(stop_ids, dtype=str)
+    counts = np.asarray(counts[0], dtype=int) if counts else np.ones(len(mon_ids), dtype=int)
+    # NULL (no settle_time) is False
+    settled = np.asarray(settled, dtype=bool)
+    return tuple(
+        group_sightings(mon_ids[rows], spawn_ids[rows], stop_ids[rows], counts[rows])
+        for rows in (settled, ~settled)
+    )
+
+def merge_groups(*groups):
+    return group_sightings(*[np.concatenate(column) for column in zip(*groups)])
+
+def top_mons(parks, groups, spawns, stops):
+    """
+    Returns {park: (pokemon_id, count)} for the most seen nesting mon of each park.
+    groups are grouped sightings as returned by group_sightings, spawns and stops are (ids, point_idx, park_idx)
+    as returned by ParkIndex.assign. A sighting counts for a park if either its spawnpoint or its pokestop
+    is in it, same as the mons query does.
+    """
+    mon_ids, spawn_ids, stop_ids, counts = groups
+    if len(mon_ids) == 0:
+        return {}
+    spawn_groups, spawn_parks = join(lookup(spawns[0], spawn_ids), spawns[1], spawns[2])
+    stop_groups, stop_parks = join(lookup(stops[0], stop_ids), stops[1], stops[2])
+
+    # A sighting with both its spawnpoint and its pokestop in a park still only counts once
+    pairs = np.unique(np.stack([
+        np.concatenate([spawn_groups, stop_groups]),
+        np.concatenate([spawn_parks, stop_parks])
+    ], axis=1).reshape(-1, 2), axis=0)
+    group_idx, park_idx = pairs[:, 0], pairs[:, 1]
+
+    result = most_common(park_idx, mon_ids[group_idx], counts[group_idx], len(parks))
+    return {parks[i]: data for i, data in result.items()}
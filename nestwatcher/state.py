@@ -0,0 +1,51 @@
+import json
+
+from nestwatcher.binfile import atomic_write
+from nestwatcher.logging import log
+from nestwatcher.spatial import group_sightings
+
+# Scanners stamp sightings with their own clock and may write them a while later. Only sightings older than
+# this (by the scanner DB's clock) are stored, newer ones are read again by the next run
+SETTLE_TIME = 30 * 60
+
+def state_file_name(area):
+    return f"data/state_data/{area.name}.json"
+
+def state_key(config, area, nest_mons, reset_time):
+    # Stored counts are only valid for the same migration, species and area
+    return {
+        "scanner": config.scanner,
+        "pokemon": config.custom_pokemon,
+        "reset_time": int(reset_time),
+        "nest_mons": sorted(nest_mons),
+        "bounds": list(area.polygon.bounds)
+    }
+
+def load_state(config, area, nest_mons, reset_time):
+    """Returns (watermark, sighting groups) of the last run, or None if there's nothing to build on"""
+    try:
+        with open(state_file_name(area), mode="r", encoding="utf-8") as state_file:
+            state = json.load(state_file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if state.get("key") != state_key(config, area, nest_mons, reset_time):
+        log.info("Stored nest state is from another migration or setup. Starting over")
+        return None
+
+    groups = state["groups"]
+    return state["watermark"], group_sightings(groups["mon_ids"], groups["spawn_ids"], groups["stop_ids"], groups["counts"])
+
+def save_state(config, area, nest_mons, reset_time, watermark, groups):
+    mon_ids, spawn_ids, stop_ids, counts = groups
+    state = {
+        "key": state_key(config, area, nest_mons, reset_time),
+        "watermark": watermark,
+        "groups": {
+            "mon_ids": mon_ids.tolist(),
+            "spawn_ids": spawn_ids.tolist(),
+            "stop_ids": stop_ids.tolist(),
+            "counts": counts.tolist()
+        }
+    }
+    with atomic_write(state_file_name(area), encoding="utf-8") as state_file:
+        state_file.write(json.dumps(state))
@@ -0,0 +1,137 @@
+import json
+import os
+import sys
+import threading
+import time
+import timeit
+
+from collections import defaultdict
+from contextlib import contextmanager
+
+from nestwatcher.binfile import atomic_write
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+def reset_peak_memory():
+    """Starts peak_memory over at the current RSS. Only Linux can do that, returns whether it worked"""
+    try:
+        with open("/proc/self/clear_refs", mode="w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def peak_memory():
+    """Peak RSS of this process in bytes since it started or reset_peak_memory, None where that isn't available"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+class RunStats():
+    """
+    Timers and counters of one area's run. Queries run on several threads with a connection pool,
+    so everything that's added goes through a lock.
+    """
+    def __init__(self, area=None):
+        self.area = area
+        self.started = time.time()
+        # Several areas can run one after another in the same process. Where the peak can't be reset for each,
+        # it's the peak of the whole process so far
+        self.memory_scope = "area" if area is not None and reset_peak_memory() else "process"
+        self.stages = defaultdict(float)
+        self.queries = defaultdict(lambda: {"count": 0, "rows": 0, "seconds": 0.0})
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, stage):
+        start = timeit.default_timer()
+        try:
+            yield
+        finally:
+            self.add_time(stage, timeit.default_timer() - start)
+
+    def add_time(self, stage, seconds):
+        with self._lock:
+            self.stages[stage] += seconds
+
+    def query(self, name, seconds, rows, count=1):
+        with self._lock:
+            query = self.queries[name]
+            query["count"] += count
+            query["rows"] += rows
+            query["seconds"] += seconds
+
+    def report(self, parks=None, nests=0):
+        return {
+            "area": self.area,
+            "started": int(self.started),
+            "seconds": round(time.time() - self.started, 3),
+            "stages": {stage: round(seconds, 3) for stage, seconds in self.stages.items()},
+            "queries": {name: dict(query, seconds=round(query["seconds"], 3)) for name, query in self.queries.items()},
+            "parks": dict(parks or {}),
+            "nests": nests,
+            "peak_memory": peak_memory(),
+            "peak_memory_scope": self.memory_scope
+        }
+
+def _write(file_name, text):
+    # Readers like node_exporter never see half of it
+    directory = os.path.dirname(file_name)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with atomic_write(file_name, encoding="utf-8") as f:
+        f.write(text)
+
+def write_report(file_name, reports):
+    _write(file_name, json.dumps({"finished": int(time.time()), "areas": reports}, indent=4))
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def write_prometheus(file_name, reports):
+    """Writes the reports in Prometheus' text format, e.g. for node_exporter's textfile collector"""
+    metrics = {
+        "nestwatcher_stage_seconds": ("Seconds spent in each stage of the last run", []),
+        "nestwatcher_queries": ("DB queries of the last run", []),
+        "nestwatcher_query_rows": ("Rows returned or written by DB queries of the last run", []),
+        "nestwatcher_query_seconds": ("Seconds spent on DB queries of the last run", []),
+        "nestwatcher_parks": ("Parks of the last run by result", []),
+        "nestwatcher_nests": ("Nests found in the last run", []),
+        "nestwatcher_run_seconds": ("Duration of the last run", []),
+        "nestwatcher_peak_memory_bytes": ("Peak memory while analyzing the area", []),
+        "nestwatcher_process_peak_memory_bytes": ("Peak memory of the process that analyzed the area since it started", []),
+        "nestwatcher_last_run_timestamp_seconds": ("Start of the last run", [])
+    }
+    for report in reports:
+        area = f'area="{_label(report["area"])}"'
+        for stage, seconds in report["stages"].items():
+            metrics["nestwatcher_stage_seconds"][1].append((f'{area},stage="{_label(stage)}"', seconds))
+        for name, query in report["queries"].items():
+            labels = f'{area},query="{_label(name)}"'
+            metrics["nestwatcher_queries"][1].append((labels, query["count"]))
+            metrics["nestwatcher_query_rows"][1].append((labels, query["rows"]))
+            metrics["nestwatcher_query_seconds"][1].append((labels, query["seconds"]))
+        for result, count in report["parks"].items():
+            metrics["nestwatcher_parks"][1].append((f'{area},result="{_label(result)}"', count))
+        metrics["nestwatcher_nests"][1].append((area, report["nests"]))
+        metrics["nestwatcher_run_seconds"][1].append((area, report["seconds"]))
+        if report["peak_memory"] is not None:
+            name = "nestwatcher_peak_memory_bytes" if report["peak_memory_scope"] == "area" else "nestwatcher_process_peak_memory_bytes"
+            metrics[name][1].append((area, report["peak_memory"]))
+        metrics["nestwatcher_last_run_timestamp_seconds"][1].append((area, report["started"]))
+
+    lines = []
+    for name, (help_text, samples) in metrics.items():
+        if not samples:
+            continue
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in samples:
+            lines.append(f"{name}{{{labels}}} {value}")
+    _write(file_name, "\n".join(lines) + "\n")
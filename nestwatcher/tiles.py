@@ -0,0 +1,51 @@
+import math
+import os
+
+from shapely import geometry
+from shapely.prepared import prep
+
+from nestwatcher.logging import log
+from nestwatcher.osmfile import from_json, merge, read_osm
+
+# OSM data is stored per tile of a fixed lat/lon grid instead of per area, so overlapping areas share it
+# and renaming an area doesn't throw it away. Tiles are named by their grid position: "{lat index}_{lon index}"
+
+def tile_dir(date, size):
+    return f"data/osm_data/tiles {date.replace(':', '')} {size}"
+
+def tile_path(date, size, key):
+    return os.path.join(tile_dir(date, size), f"{key}.osm")
+
+def tile_bounds(key, size):
+    """(min lat, min lon, max lat, max lon) of a tile"""
+    lat, lon = [int(i) for i in key.split("_")]
+    return round(lat * size, 7), round(lon * size, 7), round((lat + 1) * size, 7), round((lon + 1) * size, 7)
+
+def tile_bbox(key, size):
+    # Overpass' bbox: south,west,north,east
+    return ",".join(str(c) for c in tile_bounds(key, size))
+
+def area_tiles(polygon, size):
+    """Keys of all tiles that intersect an area's polygon (lon/lat)"""
+    min_lon, min_lat, max_lon, max_lat = polygon.bounds
+    fence = prep(polygon)
+    keys = []
+    for lat in range(math.floor(min_lat / size), math.floor(max_lat / size) + 1):
+        for lon in range(math.floor(min_lon / size), math.floor(max_lon / size) + 1):
+            key = f"{lat}_{lon}"
+            south, west, north, east = tile_bounds(key, size)
+            if fence.intersects(geometry.box(west, south, east, north)):
+                keys.append(key)
+    return keys
+
+def merge_osm(file_names):
+    """OSM data of several files as one. See osmfile.merge"""
+    osm_datas = []
+    for file_name in file_names:
+        try:
+            osm_datas.append(read_osm(file_name))
+        except (FileNotFoundError, ValueError):
+            log.error(f"Couldn't read OSM data from {file_name}. Parks in it will be missing")
+    if not osm_datas:
+        return from_json({})
+    return merge(osm_datas)
@@ -1,4 +1,5 @@
 import os
+import argparse
 import discord
 import csv
 import json
@@ -9,14 +10,20 @@ from configparser import ConfigParser
 
 from nestwatcher.config import Config
 from nestwatcher.area import get_zoom, Area
+from nestwatcher.profiling import profiled
 from nestwatcher.queries import Queries
 
+parser = argparse.ArgumentParser()
+parser.add_argument("-p", "--profile", action='store_true', help="Profile fetching OSM data for all areas and save the stats to data/profiles")
+args = parser.parse_args()
+
 tools = {
     "1": "Update area_data using Discord",
     "2": "Migrate data to a newer version",
     "3": "Update area_data using up-to-date OSM data",
     "4": "Delete all Discord emotes",
-    "5": "Fetch OSM data for all areas"
+    "5": "Fetch OSM data for all areas",
+    "6": "Convert OSM data to the compact format"
 }
 
 print("What are you looking for?")
@@ -382,13 +389,37 @@ elif wanted == "4":
     print("Done. Now re-run the analyzer to regenerate emotes")
 
 elif wanted == "5":
-    from nestwatcher.overpass import get_osm_data
-    from nestwatcher.analyze import osm_date
+    from nestwatcher.analyze import fetch_osm_data
     print("starting now")
     with open("config/areas.json", "r") as area_file:
         raw_areas = json.load(area_file)
-    for area in raw_areas:
-        area = Area(area)
-        file_name = f"data/osm_data/{area.name} {osm_date().replace(':', '')}.json"
-        nest_json = get_osm_data(area.bbox, osm_date(), file_name)
+    areas = [Area(area) for area in raw_areas]
+    # All areas are fetched at the same time, as far as Overpass' rate limit allows. So there's only one profile
+    # for all of them, named after the areas
+    profile_name = ", ".join(area.name for area in areas)
+    if len(profile_name) > 100:
+        profile_name = f"{len(areas)} areas"
+    profiled(args.profile, f"{profile_name} osm", fetch_osm_data, config, areas, refresh=True)
+    print("All done")
+
+elif wanted == "6":
+    from nestwatcher.osmfile import convert_osm
+    # The analyzer converts OSM files it needs on its own, this does all of them at once
+    json_files = []
+    for directory, _, file_names in os.walk("data/osm_data"):
+        json_files += [os.path.join(directory, f) for f in file_names if f.endswith(".json")]
+    print(f"Found {len(json_files)} OSM files to convert. Delete them after converting? (y/n)")
+    delete = ""
+    while delete.lower() not in ("y", "n"):
+        delete = input("[y/n] ")
+    for json_file in json_files:
+        osm_file = json_file.rsplit(".", 1)[0] + ".osm"
+        try:
+            convert_osm(json_file, osm_file)
+        except Exception as e:
+            print(f"Couldn't convert {json_file}: {e}")
+            continue
+        print(f"{json_file} -> {osm_file} ({os.path.getsize(json_file) // 1024} KiB -> {os.path.getsize(osm_file) // 1024} KiB)")
+        if delete.lower() == "y":
+            os.remove(json_file)
     print("All done")
\ No newline at end of file